@@ -3,22 +3,36 @@
 # filename: captcha/__init__.py
 
 import os
+from io import BytesIO
 from PIL import Image
+import numpy as np
 from .preprocess import ImageProcessor
-from .classifier import KNN, SVM, RandomForest
-from .const import Captcha_Cache_Dir
-from .util import Singleton, MD5, SHA1, ImmutableAttrsMixin
-
-__all__ = ["CaptchaRecognizer",]
-
-
-class CaptchaRecognitionResult(ImmutableAttrsMixin):
-
-    def __init__(self, code, segs, spans, cache):
-        self.code = code
-        self.segs = tuple(segs)
-        self.spans = tuple(spans)
-        self.cache = tuple(cache)
+from .bitmap import Bitmap
+from .classifier import KNN, SVM, RandomForest, Ensemble, policy_classifier
+from .sink import ArtifactSink
+from .dataset import CaptchaDataset
+from .memo import SegmentCache
+from .metrics import metrics
+from .service import CaptchaService
+from .const import Cache_Dir, Captcha_Cache_Dir
+from .util import Singleton, MD5, SHA1, FrozenSlotsMixin, mkdir
+from .exceptions import ImageProcessorException, CaptchaRejectedException
+
+__all__ = ["CaptchaRecognizer","CaptchaService","ArtifactSink","CaptchaDataset","SegmentCache","Bitmap","metrics",]
+
+
+class CaptchaRecognitionResult(FrozenSlotsMixin):
+    """ 识别结果，创建后不可修改，可以在多个线程中同时创建 """
+    __slots__ = ("code","segs","spans","cache","raw","denoised","confidence")
+
+    def __init__(self, code, segs, spans, cache, raw=None, denoised=None, confidence=None):
+        self._set("code", code)
+        self._set("segs", tuple(segs))
+        self._set("spans", tuple(spans))
+        self._set("cache", tuple(cache))
+        self._set("raw", raw)
+        self._set("denoised", denoised)
+        self._set("confidence", tuple(confidence or ()))
 
     def clean_cache(self):
         for file in self.cache:
@@ -41,54 +55,179 @@ class CaptchaRecognitionResult(ImmutableAttrsMixin):
 
 
 class CaptchaRecognizer(object, metaclass=Singleton):
+    """ 验证码识别
+
+        默认全程在内存中处理：从 BytesIO 解码，降噪与切割使用 bool 数组（True 为白），
+        切割块与降噪图随后按位打包为 Bitmap，特征提取、缓存和结果都直接使用打包后的形式。
+        只有开启 Capture_Artifacts（或调用时传入 capture=True）才会把原图、
+        降噪图和切割块写入 Captcha_Cache_Dir，用于排查误识别。
+        也可以设置 sink 为 ArtifactSink，由后台线程采样写入，不阻塞识别。
+
+        相同的切割块经常重复出现，预测结果缓存在 segment_cache 中，
+        Segment_Cache_Size 为 0 时不缓存，更换模型后应调用 invalidate_cache。
+
+        每个字符附带置信度，任一字符低于 Reject_Threshold 时抛出
+        CaptchaRejectedException，调用方可直接换一张验证码而不必提交。
 
-    Classifier = SVM
+        设置 dataset 为 CaptchaDataset 后，report 会记录校验通过的验证码的切割块及标签，
+        供 captcha.retrain 重新训练模型。
+
+        分类器由 model/policy.json（captcha.selection 生成）选定，没有该文件时使用 SVM，
+        运行时可以用 set_classifier 更换。
+
+        设置 metrics.enabled = True 后，各阶段耗时记录在 captcha.metrics 中
+    """
+    Capture_Artifacts = False
+    Segment_Cache_Size = 4096
+    Reject_Threshold = 0.0
     __HashFunc = MD5
 
     def __init__(self):
-        self.clf = self.__class__.Classifier()
+        self.clf = policy_classifier()
+        self.sink = None
+        self.dataset = None
+        size = self.__class__.Segment_Cache_Size
+        self.segment_cache = SegmentCache(size) if size > 0 else None
 
     @staticmethod
     def __abs_cp(path):
         return os.path.abspath(os.path.join(Captcha_Cache_Dir, path))
 
-    def recognize(self, imgBytes):
+    def warmup(self):
+        """ 提前加载模型，避免第一张验证码承担加载耗时 """
+        self.clf.warmup()
+        return self
+
+    def invalidate_cache(self):
+        if self.segment_cache is not None:
+            self.segment_cache.clear()
+
+    def set_classifier(self, clf):
+        """ 更换分类器（例如 Ensemble），同时清空切割块缓存 """
+        self.clf = clf
+        self.invalidate_cache()
+
+    def _predict(self, segs):
+        """ 先查切割块缓存，只对未命中的切割块提取特征并预测，返回 (chars, confs) """
+        cache = self.segment_cache
+        if cache is None:
+            chars, confs = self.clf.classify(segs)
+            return [str(ch) for ch in chars], [float(c) for c in confs]
+
+        keys = [cache.key(seg) for seg in segs]
+        hits = [cache.get(key) for key in keys]
+        missing = [idx for idx, hit in enumerate(hits) if hit is None]
+        if missing:
+            chars, confs = self.clf.classify([ segs[idx] for idx in missing ])
+            for idx, ch, conf in zip(missing, chars, confs):
+                hits[idx] = (str(ch), float(conf))
+                cache.put(keys[idx], hits[idx])
+        return [ch for ch, _ in hits], [conf for _, conf in hits]
+
+    def _check_confidence(self, result):
+        threshold = self.Reject_Threshold
+        if threshold > 0 and min(result.confidence) < threshold:
+            raise CaptchaRejectedException(
+                "confidence %.2f < %.2f" % (min(result.confidence), threshold), result=result)
+        return result
+
+    def _preprocess(self, imgBytes, capture=None):
+        """ 解码、降噪并切割，返回 (imgHash, segs, spans, cache, ary) """
+
+        if capture is None:
+            capture = self.__class__.Capture_Artifacts
 
         cache = []
-        imgHash = self.__class__.__HashFunc(imgBytes)
+        imgHash = None
 
-        rawImgCacheFile = self.__abs_cp("%s.raw.jpg" % imgHash)
-        with open(rawImgCacheFile, "wb") as fp:
-            fp.write(imgBytes)
-        cache.append(rawImgCacheFile)
+        t0 = metrics.start()
+        img = Image.open(BytesIO(imgBytes))
+        ary = np.array(img.convert("1"))
+        metrics.lap("decode", t0)
 
-        img = Image.open(rawImgCacheFile)
-        img = img.convert("1")
+        ary = ImageProcessor.denoise8(ary, repeat=1)
+        ary = ImageProcessor.denoise24(ary, repeat=1)
 
-        img = ImageProcessor.denoise8(img, repeat=1)
-        img = ImageProcessor.denoise24(img, repeat=1)
-        denoisedImgCacheFile = self.__abs_cp("%s.denoised.jpg" % imgHash)
-        img.save(denoisedImgCacheFile)
-        cache.append(denoisedImgCacheFile)
+        if capture:
+            mkdir(Cache_Dir)
+            mkdir(Captcha_Cache_Dir)
+            imgHash = self.__class__.__HashFunc(imgBytes)
 
-        segs, spans = ImageProcessor.crop(img)
+            rawImgCacheFile = self.__abs_cp("%s.raw.jpg" % imgHash)
+            with open(rawImgCacheFile, "wb") as fp:
+                fp.write(imgBytes)
+            cache.append(rawImgCacheFile)
 
-        Xlist = [self.clf.feature(segImg) for segImg in segs]
-        chars = self.clf.predict(Xlist)
-        captcha = "".join(chars)
+            denoisedImgCacheFile = self.__abs_cp("%s.denoised.jpg" % imgHash)
+            Image.fromarray(ary).save(denoisedImgCacheFile)
+            cache.append(denoisedImgCacheFile)
 
-        for idx, (segImg, ch) in enumerate(zip(segs, chars)):
-            segImgCacheFile = self.__abs_cp("%s.seg%d.%s.jpg" % (imgHash, idx, ch))
-            segImg.save(segImgCacheFile)
-            cache.append(segImgCacheFile)
+        segs, spans = ImageProcessor.crop(ary)
+        segs = [ Bitmap.from_array(seg) for seg in segs ]
+
+        return imgHash, segs, spans, cache, Bitmap.from_array(ary)
+
+    def _build_result(self, imgBytes, imgHash, segs, spans, cache, ary, chars, confs):
+        captcha = "".join(chars)
 
-        return CaptchaRecognitionResult(captcha, segs, spans, cache)
+        if imgHash is not None:
+            for idx, (seg, ch) in enumerate(zip(segs, chars)):
+                segImgCacheFile = self.__abs_cp("%s.seg%d.%s.jpg" % (imgHash, idx, ch))
+                Image.fromarray(np.asarray(seg)).save(segImgCacheFile)
+                cache.append(segImgCacheFile)
+
+        result = CaptchaRecognitionResult(captcha, segs, spans, cache, imgBytes, ary, confs)
+        if self.sink is not None:
+            self.sink.capture(result)
+        return result
+
+    def recognize(self, imgBytes, capture=None):
+        t0 = metrics.start()
+        imgHash, segs, spans, cache, ary = self._preprocess(imgBytes, capture)
+        chars, confs = self._predict(segs)
+        result = self._build_result(imgBytes, imgHash, segs, spans, cache, ary, chars, confs)
+        metrics.lap("recognize", t0)
+        return self._check_confidence(result)
+
+    def report(self, result, passed):
+        """ 回报服务器的校验结果，失败的验证码交给 sink 保存，通过的验证码记入 dataset """
+        if not passed and self.sink is not None:
+            self.sink.capture_failure(result)
+        if passed and self.dataset is not None:
+            self.dataset.add(result)
+
+    def recognize_many(self, imgBytesList, capture=None):
+        """ 批量识别，所有未命中缓存的切割块的特征合并后只调用一次 predict
+
+            返回与输入等长的列表，元素为 CaptchaRecognitionResult，
+            若某张图无法解码、切割或置信度过低，则对应位置为异常实例，不影响其他图片
+        """
+        results = [None] * len(imgBytesList)
+        prepared = []
+        for idx, imgBytes in enumerate(imgBytesList):
+            try:
+                prepared.append( (idx, (imgBytes,) + self._preprocess(imgBytes, capture)) )
+            except (ImageProcessorException, OSError) as e:
+                results[idx] = e
+
+        if prepared:
+            chars, confs = self._predict([ seg for _, p in prepared for seg in p[2] ])
+            offset = 0
+            for idx, p in prepared:
+                n = len(p[2])
+                result = self._build_result(*p, chars[offset:offset+n], confs[offset:offset+n])
+                try:
+                    results[idx] = self._check_confidence(result)
+                except CaptchaRejectedException as e:
+                    results[idx] = e
+                offset += n
+
+        return results
 
 
 recognizer = CaptchaRecognizer()
 
-def recognize_captcha(img_bytes):
-    captcha = recognizer.recognize(img_bytes)
-    code = captcha.code
-    captcha.clean_cache()
-    return code
+def recognize_captcha(img_bytes, capture=False):
+    """ 默认不落盘，capture=True 时保留中间图片 """
+    captcha = recognizer.recognize(img_bytes, capture=capture)
+    return captcha.code
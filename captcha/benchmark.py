@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# filename: captcha/benchmark.py
+
+"""
+验证码识别的吞吐量与延迟基准测试，使用 synthetic 生成的验证码，不需要访问 DrawServlet
+
+    python3 -m captcha.benchmark [-n 500] [--seed 0] [-o result.json]
+    python3 -m captcha.benchmark --service 1,2,4,8
+    python3 -m captcha.benchmark --memory
+    python3 -m captcha.benchmark --threads 8
+
+对 model/ 下的每个模型分别统计 decode / denoise8 / denoise24 / crop / feature / predict
+各阶段的耗时分布与端到端吞吐量，结果以 JSON 保存，便于在不同提交之间对比。
+合成验证码与真实验证码差别很大，其中的准确率不反映线上表现，只用于发现同一语料上的结果变化；
+评估准确率需要服务器确认过的真实验证码。
+--service 统计 CaptchaService 在不同工作进程数下的吞吐量，及相对 1 个进程和相对当前进程内串行识别的加速比，
+--memory 用 tracemalloc 统计单张识别的临时峰值、每个结果常驻的内存与批量识别的峰值内存，
+--threads 从多个线程同时调用 recognizer.recognize，检查结果与单线程一致
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+import platform
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from PIL import Image
+import numpy as np
+from .const import Base_Dir
+from .preprocess import ImageProcessor
+from .classifier import get_model_files, get_classifier
+from .synthetic import CaptchaGenerator
+from . import recognizer
+from .service import CaptchaService
+from .exceptions import ImageProcessorException
+from .util import json_dump
+
+__all__ = ["Stages","summarize","load_classifiers","bench_classifier","bench_service",
+           "bench_inprocess","scaling","bench_memory","bench_threads","run",]
+
+
+Stages = ("decode","denoise8","denoise24","crop","feature","predict")
+
+
+def summarize(samples):
+    """ 耗时分布，单位 ms """
+    if len(samples) == 0:
+        return None
+    ary = np.asarray(samples) * 1e3
+    return {
+        "count": int(ary.size),
+        "mean": float(ary.mean()),
+        "p50": float(np.percentile(ary, 50)),
+        "p90": float(np.percentile(ary, 90)),
+        "p99": float(np.percentile(ary, 99)),
+        "max": float(ary.max()),
+    }
+
+
+def load_classifiers(algs=None):
+    """ 返回 {alg: (classifier, detail)}，无法加载的模型为 (异常实例, detail) """
+    classifiers = {}
+    for alg, detail in sorted(get_model_files().items()):
+        if algs and alg not in algs:
+            continue
+        try:
+            classifiers[alg] = (get_classifier(alg).warmup(), detail)
+        except Exception as e:
+            classifiers[alg] = (e, detail)
+    return classifiers
+
+
+def bench_classifier(clf, corpus):
+    timings = {stage: [] for stage in Stages}
+    total = []
+    correct = chars = charsCorrect = failed = 0
+
+    for label, imgBytes in corpus:
+        t0 = time.perf_counter()
+        ary = np.array(Image.open(BytesIO(imgBytes)).convert("1"))
+        t1 = time.perf_counter()
+        ary = ImageProcessor.denoise8(ary, repeat=1)
+        t2 = time.perf_counter()
+        ary = ImageProcessor.denoise24(ary, repeat=1)
+        t3 = time.perf_counter()
+        try:
+            segs, _ = ImageProcessor.crop(ary)
+        except ImageProcessorException:
+            failed += 1
+            total.append(time.perf_counter() - t0)
+            continue
+        t4 = time.perf_counter()
+        X = np.vstack([ clf.feature(seg) for seg in segs ])
+        t5 = time.perf_counter()
+        code = "".join(clf.predict(X))
+        t6 = time.perf_counter()
+
+        for stage, dt in zip(Stages, (t1-t0, t2-t1, t3-t2, t4-t3, t5-t4, t6-t5)):
+            timings[stage].append(dt)
+        total.append(t6 - t0)
+        correct += code == label
+        chars += len(label)
+        charsCorrect += sum(a == b for a, b in zip(code, label))
+
+    n = len(corpus)
+    return {
+        "stages": {stage: summarize(timings[stage]) for stage in Stages},
+        "end_to_end": summarize(total),
+        "throughput": n / sum(total) if total else 0.0, # captchas / s
+        "accuracy": correct / n if n else 0.0,
+        "char_accuracy": charsCorrect / chars if chars else 0.0,
+        "crop_failures": failed,
+    }
+
+
+def bench_service(corpus, workers):
+    """ 所有验证码一次性提交给 CaptchaService，统计吞吐量 """
+    with CaptchaService(workers=workers).warmup() as service:
+        t0 = time.perf_counter()
+        futures = [ service.submit(imgBytes) for _, imgBytes in corpus ]
+        failed = 0
+        for future in futures:
+            if future.exception() is not None:
+                failed += 1
+        elapsed = time.perf_counter() - t0
+    return {
+        "workers": workers,
+        "throughput": len(corpus) / elapsed,
+        "failures": failed,
+    }
+
+
+def bench_inprocess(corpus):
+    """ 在当前进程中串行识别同一批验证码，作为 CaptchaService 的对照 """
+    recognizer.warmup()
+    t0 = time.perf_counter()
+    for _, imgBytes in corpus:
+        _recognize_code(imgBytes)
+    return len(corpus) / (time.perf_counter() - t0)
+
+
+def scaling(entries, inprocess):
+    """ 给 bench_service 的结果加上相对 1 个进程（没有测 1 个进程时为最少的进程数）和相对进程内串行的加速比 """
+    base = min(entries, key=lambda entry: entry["workers"])["throughput"]
+    for entry in entries:
+        entry["speedup"] = entry["throughput"] / base
+        entry["speedup_inprocess"] = entry["throughput"] / inprocess
+    return entries
+
+
+def bench_memory(corpus):
+    """ 关闭切割块缓存后统计内存，单位 KiB """
+    imgs = [ imgBytes for _, imgBytes in corpus ]
+    segmentCache = recognizer.segment_cache
+    recognizer.segment_cache = None
+    recognizer.warmup()
+    tracemalloc.start()
+    try:
+        peaks = []
+        results = []
+        base = tracemalloc.get_traced_memory()[0]
+        for imgBytes in imgs:
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            try:
+                results.append(recognizer.recognize(imgBytes, capture=False))
+            except (ImageProcessorException, OSError):
+                pass
+            peaks.append(tracemalloc.get_traced_memory()[1] - current)
+        retained = tracemalloc.get_traced_memory()[0] - base
+        del results
+
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        recognizer.recognize_many(imgs, capture=False)
+        batchPeak = tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+        recognizer.segment_cache = segmentCache
+    return {
+        "captcha_peak": float(np.mean(peaks)) / 1024 if peaks else 0.0,
+        "result_retained": retained / max(len(peaks), 1) / 1024,
+        "batch_peak": batchPeak / 1024,
+    }
+
+
+def _recognize_code(imgBytes):
+    try:
+        return recognizer.recognize(imgBytes, capture=False).code
+    except ImageProcessorException as e:
+        return e.__class__.__name__
+
+
+def bench_threads(corpus, threads, rounds=4):
+    """ 压力测试：threads 个线程同时识别，返回与单线程结果不一致的数量和线程中的异常 """
+    imgs = [ imgBytes for _, imgBytes in corpus ]
+    recognizer.warmup()
+    expected = [ _recognize_code(imgBytes) for imgBytes in imgs ]
+    mismatches = 0
+    errors = []
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        t0 = time.perf_counter()
+        futures = [ pool.submit(_recognize_code, imgBytes) for _ in range(rounds) for imgBytes in imgs ]
+        for idx, future in enumerate(futures):
+            try:
+                mismatches += future.result() != expected[idx % len(imgs)]
+            except Exception as e:
+                errors.append("%s: %s" % (e.__class__.__name__, e))
+        elapsed = time.perf_counter() - t0
+    return {
+        "threads": threads,
+        "throughput": len(futures) / elapsed,
+        "mismatches": mismatches,
+        "errors": errors[:10],
+        "error_count": len(errors),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git","rev-parse","HEAD"], cwd=Base_Dir,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(n=500, seed=0, algs=None, service=(), memory=False, threads=()):
+    corpus = CaptchaGenerator(seed=seed).generate_many(n)
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "n": n,
+            "seed": seed,
+            "engine": ImageProcessor.Engine,
+        },
+        "models": {},
+    }
+    for alg, (clf, detail) in load_classifiers(algs).items():
+        entry = {
+            "feature": detail["feature"],
+            "level": detail["level"],
+            "file": os.path.basename(detail["path"]),
+        }
+        if isinstance(clf, Exception):
+            entry["error"] = "%s: %s" % (clf.__class__.__name__, clf)
+        else:
+            entry.update(bench_classifier(clf, corpus))
+        report["models"][alg] = entry
+    if service:
+        report["inprocess"] = bench_inprocess(corpus)
+        report["service"] = scaling([ bench_service(corpus, workers) for workers in service ], report["inprocess"])
+    if memory:
+        report["memory"] = bench_memory(corpus)
+    if threads:
+        report["threads"] = [ bench_threads(corpus, n) for n in threads ]
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python3 -m captcha.benchmark", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", type=int, default=500, help="number of synthetic captchas; they measure speed only, not accuracy")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--alg", action="append", help="only benchmark these algorithms")
+    parser.add_argument("--service", help="comma separated worker counts for CaptchaService, e.g. 1,2,4")
+    parser.add_argument("--memory", action="store_true", help="measure peak and retained memory with tracemalloc")
+    parser.add_argument("--threads", help="comma separated thread counts for the recognizer stress test, e.g. 2,8")
+    parser.add_argument("-o", "--output", help="save the report as JSON")
+    args = parser.parse_args(argv)
+
+    service = [ int(w) for w in args.service.split(",") ] if args.service else ()
+    threads = [ int(n) for n in args.threads.split(",") ] if args.threads else ()
+    report = run(args.n, args.seed, args.alg, service, args.memory, threads)
+    for alg, entry in report["models"].items():
+        if "error" in entry:
+            print("%-12s error: %s" % (alg, entry["error"]))
+            continue
+        print("%-12s f%s  %7.1f captcha/s  accuracy %.3f  char %.3f  crop failures %d" % (
+            alg, entry["feature"], entry["throughput"], entry["accuracy"],
+            entry["char_accuracy"], entry["crop_failures"]))
+        for stage in Stages:
+            s = entry["stages"][stage]
+            if s is not None:
+                print("    %-10s p50 %7.3f  p90 %7.3f  p99 %7.3f ms" % (stage, s["p50"], s["p90"], s["p99"]))
+    if "inprocess" in report:
+        print("in-process         %7.1f captcha/s  (%s cpus)" % (report["inprocess"], report["meta"]["cpus"]))
+    for entry in report.get("service", ()):
+        print("service %2d workers  %7.1f captcha/s  x%.2f vs %d worker  x%.2f vs in-process" % (
+            entry["workers"], entry["throughput"], entry["speedup"], min(service), entry["speedup_inprocess"]))
+    for entry in report.get("threads", ()):
+        print("threads %2d  %7.1f captcha/s  mismatches %d  errors %d" % (
+            entry["threads"], entry["throughput"], entry["mismatches"], entry["error_count"]))
+    if "memory" in report:
+        print("memory  per captcha peak %.1f KiB  retained %.2f KiB  batch of %d peak %.1f KiB" % (
+            report["memory"]["captcha_peak"], report["memory"]["result_retained"], args.n,
+            report["memory"]["batch_peak"]))
+    if args.output:
+        json_dump(report, args.output, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
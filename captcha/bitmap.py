@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# filename: captcha/bitmap.py
+
+import numpy as np
+
+__all__ = ["Bitmap",]
+
+
+class Bitmap(object):
+    """ 按位打包的二值图，每像素 1 bit
+
+        bits 为黑色像素（笔画）为 1 的 packbits 结果，解包即得到特征所需的 0/1 数组，
+        不必再做 1 - ary 的反相。np.asarray(bitmap) 还原为 bool 数组（True 为白）
+    """
+    __slots__ = ("shape","bits")
+
+    def __init__(self, shape, bits):
+        self.shape = tuple(shape)
+        self.bits = bits
+
+    @classmethod
+    def from_array(cls, ary):
+        """ ary 为 bool 数组（True 为白） """
+        return cls(ary.shape, np.packbits(~ary))
+
+    @classmethod
+    def from_image(cls, img):
+        return cls.from_array(np.array(img.convert("1")))
+
+    @property
+    def size(self):
+        height, width = self.shape
+        return height * width
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def ink(self):
+        """ 0/1 的 uint8 数组，黑为 1 """
+        return np.unpackbits(self.bits, count=self.size).reshape(self.shape)
+
+    def to_array(self):
+        """ bool 数组，True 为白 """
+        return self.ink() == 0
+
+    def key(self):
+        return self.shape, self.bits.tobytes()
+
+    def __array__(self, dtype=None, copy=None):
+        ary = self.to_array()
+        return ary if dtype is None else ary.astype(dtype)
+
+    def __eq__(self, other):
+        if not isinstance(other, Bitmap):
+            return NotImplemented
+        return self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __getstate__(self):
+        return self.shape, self.bits
+
+    def __setstate__(self, state):
+        self.shape, self.bits = state
+
+    def __repr__(self):
+        return '<%s: %dx%d>' % (self.__class__.__name__, *self.shape)
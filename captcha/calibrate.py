@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# filename: captcha/calibrate.py
+
+"""
+在带标签的切割块上校准 SVC 的置信度，并估计本地拒绝能省下多少次 validate.do
+
+    python3 -m captcha.calibrate segments.npz [--alg SVM] [--holdout 0.5] [--dry-run]
+
+segments.npz 包含 labels（字符数组）和 ink（(n, 22, 22) 的 0/1 数组，黑为 1），
+可由 tools/knn_segments.py 从 KNN 模型的训练矩阵中还原。
+
+一半切割块用于拟合 sigmoid(scale * 间隔 + offset)，即决策值间隔下识别正确的概率，
+另一半用于评估：把留出的切割块随机组成四个字符的验证码，
+对不同的 Reject_Threshold 统计被本地拒绝的比例、提交的验证码的正确率，
+以及每通过一张验证码平均需要的 validate.do 请求数与 DrawServlet 请求数。
+结果写入 model/calibration.json，只对拟合时的模型文件生效
+"""
+
+import os
+import sys
+import argparse
+import numpy as np
+from .const import Model_Calibration_JSON
+from .classifier import get_classifier, get_model_files, load_calibration
+from .svm import NumpySVC
+from .util import json_dump
+
+__all__ = ["Thresholds","fit_sigmoid","margins","round_trips","calibrate",]
+
+
+Thresholds = (0.5, 0.8, 0.9, 0.95, 0.97, 0.99)
+
+
+def fit_sigmoid(margin, correct, iterations=100):
+    """ 最大似然拟合 P(correct) = sigmoid(scale * margin + offset)，带步长减半的牛顿法 """
+    x = np.asarray(margin, dtype=np.float64)
+    t = np.asarray(correct, dtype=np.float64)
+
+    def loss(a, b):
+        z = a * x + b
+        return np.sum(np.logaddexp(0, z) - t * z)
+
+    a = b = 0.0
+    for _ in range(iterations):
+        p = 0.5 * (1 + np.tanh(0.5 * (a * x + b)))
+        w = p * (1 - p)
+        grad = np.array([ ((p - t) * x).sum(), (p - t).sum() ])
+        hess = np.array([ [(w * x * x).sum() + 1e-9, (w * x).sum()],
+                          [(w * x).sum(), w.sum() + 1e-9] ])
+        step = np.linalg.solve(hess, grad)
+        current = loss(a, b)
+        k = 1.0
+        while loss(a - k * step[0], b - k * step[1]) > current and k > 1e-8:
+            k /= 2
+        a, b = a - k * step[0], b - k * step[1]
+        if np.abs(k * step).max() < 1e-9:
+            break
+    return float(a), float(b)
+
+
+def _engine(clf):
+    """ 分类器对应的 NumpySVC，sklearn 的 SVC 按参数转换 """
+    engine = clf.warmup()._clf
+    if isinstance(engine, NumpySVC):
+        return engine
+    if hasattr(engine, "support_vectors_"):
+        return NumpySVC.from_sklearn(engine)
+    raise TypeError("%s is not an SVC model, only SVC confidences are calibrated" % clf.Algorithm)
+
+
+def margins(engine, feature, labels, ink):
+    """ 返回 (是否识别正确, 决策值间隔) """
+    X = np.vstack([ feature(seg == 0) for seg in ink ]) # True 为白
+    idx, margin = engine.margins(X)
+    return engine.classes[idx].astype(str) == np.asarray(labels).astype(str), margin
+
+
+def round_trips(correct, confidence, thresholds=Thresholds, n=100000, length=4, seed=0):
+    """ 用切割块随机组成验证码，统计不同阈值下每通过一张验证码需要的请求数 """
+    rs = np.random.RandomState(seed)
+    picks = rs.randint(0, len(correct), (n, length))
+    good = correct[picks].all(axis=1)
+    lowest = confidence[picks].min(axis=1)
+    rows = []
+    for threshold in (0.0,) + tuple(thresholds):
+        accepted = lowest >= threshold
+        submitted = int(accepted.sum())
+        passed = int((accepted & good).sum())
+        rows.append({
+            "threshold": threshold,
+            "accepted": submitted / n,
+            "precision": passed / submitted if submitted else 0.0,
+            "validations": submitted / passed if passed else float("inf"), # 每通过一张的 validate.do 请求数
+            "fetches": n / passed if passed else float("inf"),             # 每通过一张的 DrawServlet 请求数
+            "wrong_avoided": 1 - (accepted & ~good).sum() / max((~good).sum(), 1),
+        })
+    return rows
+
+
+def calibrate(alg, labels, ink, holdout=0.5, seed=0):
+    clf = get_classifier(alg)
+    engine = _engine(clf)
+    correct, margin = margins(engine, clf.feature, labels, ink)
+    order = np.random.RandomState(seed).permutation(len(correct))
+    nTest = int(len(order) * holdout)
+    test, train = order[:nTest], order[nTest:]
+    scale, offset = fit_sigmoid(margin[train], correct[train])
+
+    confidence = engine.confidence(margin[test], (scale, offset))
+    wrong = ~correct[test]
+    detail = get_model_files()[alg]
+    return {
+        "file": os.path.basename(detail["path"]),
+        "size": os.path.getsize(detail["path"]),
+        "scale": scale,
+        "offset": offset,
+        "segments": int(len(train)),
+        "char_accuracy": float(correct[test].mean()),
+        "confidence_wrong_p50": float(np.median(confidence[wrong])) if wrong.any() else None,
+        "confidence_right_p5": float(np.percentile(confidence[~wrong], 5)) if (~wrong).any() else None,
+        "round_trips": round_trips(correct[test], confidence),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python3 -m captcha.calibrate", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("segments", help="npz file with labels and ink arrays")
+    parser.add_argument("--alg", default="SVM")
+    parser.add_argument("--holdout", type=float, default=0.5, help="fraction of segments kept for evaluation")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dry-run", action="store_true", help="print the evaluation without writing calibration.json")
+    parser.add_argument("-o", "--output", default=Model_Calibration_JSON)
+    args = parser.parse_args(argv)
+
+    with np.load(args.segments) as data:
+        labels, ink = data["labels"], data["ink"]
+    result = calibrate(args.alg, labels, ink, args.holdout, args.seed)
+    result["corpus"] = os.path.basename(args.segments)
+
+    print("%s  scale %.4f  offset %.4f  fitted on %d segments, char accuracy %.4f on the rest" % (
+        args.alg, result["scale"], result["offset"], result["segments"], result["char_accuracy"]))
+    print("confidence: wrong characters p50 %s, right characters p5 %s" % (
+        result["confidence_wrong_p50"], result["confidence_right_p5"]))
+    print("threshold  accepted  precision  validate.do/pass  DrawServlet/pass  wrong avoided")
+    for row in result["round_trips"]:
+        print("%9.2f  %8.3f  %9.4f  %16.4f  %16.3f  %13.3f" % (
+            row["threshold"], row["accepted"], row["precision"], row["validations"],
+            row["fetches"], row["wrong_avoided"]))
+    if args.dry_run:
+        return
+    calibration = load_calibration(args.output)
+    calibration[args.alg] = result
+    json_dump(calibration, args.output, indent=2)
+    print("written to %s" % args.output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
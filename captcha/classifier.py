@@ -4,16 +4,24 @@
 
 import os
 import re
-from sklearn.neighbors.classification import KNeighborsClassifier
-from sklearn.svm import SVC
-from sklearn.ensemble.forest import RandomForestClassifier
-from sklearn.externals import joblib
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from .feature import FeatureExtractor
-from .const import Model_Dir
-from .util import Singleton
+from .svm import NumpySVC
+from .template import TemplateMatcher
+from .bitmap import Bitmap
+from .const import Model_Dir, Cache_Dir, Model_Cache_Dir, Model_Policy_JSON, Model_Calibration_JSON
+from .util import Singleton, mkdir, json_load
+from .metrics import metrics
 from .exceptions import ModelFileNotFoundError, ABCNotImplementedError
 
-__all__ = ["KNN","SVM","RandomForest",]
+__all__ = ["KNN","SVM","RandomForest","Template","Ensemble","Model_Format_Version","Classifiers","Default_Classifier",
+           "get_model_files","get_joblib","load_calibration","get_classifier","load_policy","policy_classifier",]
+
+
+Model_Format_Version = 1 # 未压缩模型 alg.model.fN.lN.vN.{joblib,npz} 的格式版本
 
 
 def __get_Model_Files():
@@ -25,46 +33,200 @@ def __get_Model_Files():
         r"c(?P<compress>\d{1})"     + \
         r"(?P<ext>\.z|\.gz|\.bz2|\.xz|\.lzma)$", re.I)
 
+    regex_compact_filename = re.compile(\
+        r"^(?P<alg>\S+)\.model\."   + \
+        r"f(?P<feature>[1-5])\."    + \
+        r"(?:l(?P<level>\d{1})\.)*" + \
+        r"v(?P<version>\d+)"        + \
+        r"(?P<ext>\.joblib|\.npz)$", re.I)
+
     model_files = {}
-    for file in os.listdir(Model_Dir):
+    files = sorted(os.listdir(Model_Dir))
+    for file in files:
         res = regex_model_filename.match(file)
         if res is not None:
             filename = res.group()
             resDict = res.groupdict()
             alg = resDict.pop("alg")
             resDict["path"] = os.path.abspath(os.path.join(Model_Dir, filename))
+            resDict["source"] = resDict["path"]
+            resDict["format"] = "compressed"
+            model_files[alg] = resDict
+
+    for file in files: # 优先使用未压缩的模型，其中 .npz 优先于 .joblib
+        res = regex_compact_filename.match(file)
+        if res is not None and int(res.group("version")) == Model_Format_Version:
+            filename = res.group()
+            resDict = res.groupdict()
+            alg = resDict.pop("alg")
+            if model_files.get(alg, {}).get("ext") == ".npz":
+                continue
+            resDict["path"] = os.path.abspath(os.path.join(Model_Dir, filename))
+            # 同名的压缩 pickle（如 SVM.model.f3.l1.c9.xz）不再被加载，只作为 source 保留：
+            # captcha.convert 由它重新导出 .npz，captcha.retrain 会替换它。它由 sklearn 0.19 生成，
+            # 新版 sklearn 需要旧模块名的别名才能反序列化
+            resDict["source"] = model_files[alg]["source"] if alg in model_files else resDict["path"]
+            resDict["format"] = "compact"
             model_files[alg] = resDict
 
     return model_files
 
 
-Model_Files = __get_Model_Files()
+_Model_Files = None
+
+def get_model_files(refresh=False):
+    """ 首次调用时才扫描 Model_Dir，Model_Dir 中的文件变化后传入 refresh=True 重新扫描 """
+    global _Model_Files
+    if _Model_Files is None or refresh:
+        _Model_Files = __get_Model_Files()
+    return _Model_Files
+
+
+def get_joblib():
+    """ 只有加载 pickle 模型时才导入 joblib """
+    try:
+        import joblib
+    except ImportError:
+        from sklearn.externals import joblib
+    return joblib
+
+
+def load_calibration(path=Model_Calibration_JSON):
+    """ captcha.calibrate 拟合的置信度校准，按算法名索引，没有该文件时返回 {} """
+    return json_load(path) or {}
+
+
+def _calibration(alg, detail):
+    """ 与当前模型文件对应的 (scale, offset)，模型重新训练或导出后旧的校准不再使用 """
+    entry = load_calibration().get(alg)
+    if entry is None:
+        return None
+    if entry.get("file") != os.path.basename(detail["path"]) or entry.get("size") != os.path.getsize(detail["path"]):
+        return None
+    return (entry["scale"], entry["offset"])
+
+
+def _shared_model_path(detail):
+    """ 压缩模型解压后的缓存文件，源文件的大小或修改时间变化后自动失效
+
+        同一台机器上的多个进程对该文件做只读 mmap，共享同一份物理内存
+    """
+    if detail["format"] == "compact" and detail["ext"] == ".joblib":
+        return detail["path"] # 本身未压缩，直接映射
+
+    source = detail["source"]
+    stat = os.stat(source)
+    basename = os.path.basename(source)
+    path = os.path.join(Model_Cache_Dir, "%s.%d.%d.joblib" % (basename, stat.st_size, stat.st_mtime_ns))
+    if os.path.exists(path):
+        return path
+
+    mkdir(Cache_Dir)
+    mkdir(Model_Cache_Dir)
+    joblib = get_joblib()
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    joblib.dump(joblib.load(source), tmp, compress=0)
+    os.replace(tmp, path) # 多进程同时生成时，保证读到的是完整文件
+
+    for file in os.listdir(Model_Cache_Dir): # 清理过期的缓存
+        if file.startswith(basename + ".") and file.endswith(".joblib") \
+                and file != os.path.basename(path):
+            try:
+                os.remove(os.path.join(Model_Cache_Dir, file))
+            except OSError:
+                pass
+    return path
 
 
 class ClassifierMixin(object, metaclass=Singleton):
+    """ 分类器基类，模型在第一次使用或调用 warmup 时才加载
+
+        Mmap_Mode 设为 "r" 时，模型中的大数组（SVM 的支持向量、KNN 的训练矩阵等）
+        以只读 mmap 方式加载，多个进程共享同一份页缓存
+    """
 
     Algorithm = ""
+    Mmap_Mode = None
+    Engine = NumpySVC # 加载 .npz 模型的纯 NumPy 实现
 
     def __init__(self):
         if self.__class__ == __class__:
             raise ABCNotImplementedError
-        clf, feature = self.__load_model()
-        self._clf = clf
-        self.feature = feature
+        self._clf = None
+        self._feature = None
+        self._votes = None
+        self._calibration = None
+        self._lock = threading.Lock()
 
     @classmethod
     def __load_model(cls):
         alg = cls.Algorithm
-        detail = Model_Files.get(alg)
-        path, fCode, lCode = map(detail.__getitem__, ["path","feature","level"])
-        feature = FeatureExtractor.get_feature(fCode, lCode)
-        if path is None:
+        detail = get_model_files().get(alg)
+        if detail is None:
             raise ModelFileNotFoundError("Model %s.* is mising !" % alg)
-        return joblib.load(path), feature
+        path, fCode, lCode = map(detail.__getitem__, ["path","feature","level"])
+        feature = FeatureExtractor.get_feature(fCode, lCode or "")
+        if detail["format"] == "compact" and detail["ext"] == ".npz":
+            return cls.Engine.load(path), feature, detail # 纯 NumPy 推理，不需要 sklearn
+        if cls.Mmap_Mode is not None:
+            return get_joblib().load(_shared_model_path(detail), mmap_mode=cls.Mmap_Mode), feature, detail
+        return get_joblib().load(path), feature, detail
+
+    def warmup(self):
+        """ 加载模型，可提前调用以避免首次识别时的延迟 """
+        if self._clf is None:
+            with self._lock:
+                if self._clf is None:
+                    clf, feature, detail = self.__load_model()
+                    self._feature = feature
+                    self._calibration = _calibration(self.Algorithm, detail)
+                    if isinstance(clf, NumpySVC) and self._calibration is not None:
+                        clf.calibration = self._calibration
+                    self._clf = clf
+        return self
+
+    @property
+    def feature(self):
+        if self._clf is None:
+            self.warmup()
+        return self._feature
 
     def predict(self, Xlist):
+        if self._clf is None:
+            self.warmup()
         return self._clf.predict(Xlist)
 
+    def predict_confidence(self, Xlist):
+        """ 返回 (预测字符, 置信度)，置信度在 [0,1] 之间
+
+            有 predict_proba 的模型（KNN, RandomForest）取最大概率，
+            SVC 取一对一决策值的间隔，经 model/calibration.json 中的校准映射为置信度
+        """
+        if self._clf is None:
+            self.warmup()
+        clf = self._clf
+        if hasattr(clf, "predict_confidence"):
+            return clf.predict_confidence(Xlist)
+        if hasattr(clf, "predict_proba") and getattr(clf, "probability", True):
+            proba = clf.predict_proba(Xlist)
+            idx = proba.argmax(axis=1)
+            return clf.classes_[idx], proba[np.arange(len(idx)), idx]
+        if self._votes is None:
+            votes = NumpySVC.from_sklearn(clf)
+            if self._calibration is not None:
+                votes.calibration = self._calibration
+            self._votes = votes
+        return self._votes.predict_confidence(Xlist)
+
+    def classify(self, segs):
+        """ 对切割块提取特征并调用一次 predict_confidence """
+        t0 = metrics.start()
+        X = np.vstack([ self.feature(seg) for seg in segs ])
+        t0 = metrics.lap("feature", t0)
+        res = self.predict_confidence(X)
+        metrics.lap("predict", t0)
+        return res
+
 
 class RandomForest(ClassifierMixin):
     Algorithm = "RandomForest"
@@ -74,3 +236,105 @@ class KNN(ClassifierMixin):
 
 class SVM(ClassifierMixin):
     Algorithm = "SVM"
+
+class Template(ClassifierMixin):
+    """ 汉明距离模板匹配，模型为 captcha.template 生成的 Template.model.f1.v1.npz
+
+        切割块为 Bitmap 时直接使用打包好的位，不再解包成 feature1
+    """
+    Algorithm = "Template"
+    Engine = TemplateMatcher
+
+    def classify(self, segs):
+        if not all(isinstance(seg, Bitmap) for seg in segs):
+            return super().classify(segs)
+        if self._clf is None:
+            self.warmup()
+        t0 = metrics.start()
+        X = np.vstack([ seg.bits for seg in segs ])
+        t0 = metrics.lap("feature", t0)
+        res = self._clf.predict_confidence(X)
+        metrics.lap("predict", t0)
+        return res
+
+
+class Ensemble(object):
+    """ 多个分类器在线程池中并发预测，按置信度加权投票
+
+        每个切割块的置信度为胜出字符获得的置信度之和除以分类器个数。
+        无法加载的成员（例如与当前 sklearn 不兼容的 pickle）被移出并记录在 failed 中，
+        全部成员都无法加载时抛出第一个成员的异常。没有调用 warmup 时，第一次 classify 会先做同样的处理
+    """
+
+    Algorithm = "Ensemble"
+
+    def __init__(self, members=(KNN, SVM, RandomForest)):
+        self.members = [ cls() for cls in members ]
+        self.failed = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=len(self.members), thread_name_prefix="Ensemble")
+
+    def warmup(self):
+        with self._lock:
+            if not self._loaded:
+                self._load_members()
+        return self
+
+    def _load_members(self):
+        futures = [ (clf, self._pool.submit(clf.warmup)) for clf in self.members ]
+        loaded = []
+        for clf, future in futures:
+            try:
+                future.result()
+                loaded.append(clf)
+            except Exception as e:
+                self.failed[clf.Algorithm] = e
+                warnings.warn("Ensemble member %s skipped: %s: %s" % (clf.Algorithm, e.__class__.__name__, e), RuntimeWarning)
+        if not loaded:
+            raise futures[0][1].exception()
+        self.members = loaded
+        self._loaded = True
+
+    def classify(self, segs):
+        if not self._loaded:
+            self.warmup()
+        futures = [ self._pool.submit(clf.classify, segs) for clf in self.members ]
+        outputs = [ future.result() for future in futures ]
+        nMember = len(self.members)
+        chars, confs = [], []
+        for idx in range(len(segs)):
+            score = {}
+            for labels, confidences in outputs:
+                ch = str(labels[idx])
+                score[ch] = score.get(ch, 0.0) + float(confidences[idx])
+            ch = max(score, key=score.get)
+            chars.append(ch)
+            confs.append(score[ch] / nMember)
+        return chars, confs
+
+
+Classifiers = {cls.Algorithm: cls for cls in (KNN, SVM, RandomForest, Template)}
+Default_Classifier = "SVM"
+
+
+def get_classifier(alg):
+    """ 按名称创建分类器，"Ensemble" 为 KNN、SVM、RandomForest 加权投票，
+        其他不认识的名称对应 model/ 中同名的模型文件（例如 captcha.retrain 训练的新算法）
+    """
+    if alg == "Ensemble":
+        return Ensemble()
+    cls = Classifiers.get(alg) or type(alg, (ClassifierMixin,), {"Algorithm": alg})
+    return cls()
+
+
+def load_policy(path=Model_Policy_JSON):
+    """ captcha.selection 写出的选择策略，不存在时返回 None """
+    return json_load(path)
+
+
+def policy_classifier(path=Model_Policy_JSON):
+    """ 策略中选中的分类器，没有策略文件时使用 Default_Classifier """
+    policy = load_policy(path)
+    alg = policy.get("selected") if policy else None
+    return get_classifier(alg or Default_Classifier)
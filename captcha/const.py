@@ -4,15 +4,19 @@
 
 import os
 import random
-from .util import NoInstance, mkdir
+from .util import NoInstance
 
 __all__ = [
 
     "Base_Dir",
     "Model_Dir",
     "Cache_Dir",
+    "Model_Cache_Dir",
     "Log_Dir",
     "Captcha_Cache_Dir",
+    "Dataset_Dir",
+    "Model_Policy_JSON",
+    "Model_Calibration_JSON",
 
     "Course_UTF8_CSV",
     "Course_GBK_CSV",
@@ -20,6 +24,8 @@ __all__ = [
 
     "User_Agent",
 
+    "Captcha_Alphabet",
+
     "IAAALinks",
     "ElectiveLinks",
 
@@ -33,13 +39,20 @@ __absP = lambda path: os.path.abspath(os.path.join(__base_dir, path))
 Base_Dir          = __absP("./")
 Model_Dir         = __absP("./model/")
 Cache_Dir         = __absP("./cache/")
+Model_Cache_Dir   = __absP("./cache/model/")
 Log_Dir           = __absP("./log/")
 Captcha_Cache_Dir = __absP("./cache/captcha/")
+Dataset_Dir       = __absP("./dataset/")
+Model_Policy_JSON = __absP("./model/policy.json")
+Model_Calibration_JSON = __absP("./model/calibration.json")
 
 Course_UTF8_CSV   = __absP("../course.utf-8.csv")
 Course_GBK_CSV    = __absP("../course.gbk.csv")
 Config_INI        = __absP("../config.ini")
 
+# DrawServlet 验证码使用的字符，去掉了易混淆的 4 I O Q l o，与模型的 classes_ 一致
+Captcha_Alphabet = "2356789ABCDEFGHJKLMNPRSTUVWXYZabcdefghijkmnpqrstuvwxyz"
+
 # 警惕直接复制的 User-Agent 中可能存在的省略号（通常源自 Firefox 开发者工具），它可能会引发如下错误：
 #   File "/usr/lib/python3.6/http/client.py", line 1212, in putheader
 #     values[i] = one_value.encode('latin-1')
@@ -64,10 +77,6 @@ User_Agent = random.choice([
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.10; rv:62.0) Gecko/20100101 Firefox/62.0",
     ])
 
-mkdir(Cache_Dir)
-mkdir(Log_Dir)
-mkdir(Captcha_Cache_Dir)
-
 
 class IAAALinks(object, metaclass=NoInstance):
     """
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# filename: captcha/convert.py
+
+"""
+把 model/ 下压缩的模型转换为未压缩、带版本号的格式，以缩短冷启动时间
+
+    python3 -m captcha.convert [SVM KNN RandomForest ...]
+    python3 -m captcha.convert --numpy SVM
+
+转换后的文件名为 alg.model.fN.lN.vN.joblib，与原模型放在同一目录下，
+classifier 会优先加载它。删除该文件即可回退到压缩模型。
+
+--numpy 把 SVC 的参数导出为 alg.model.fN.lN.vN.npz，运行时由 NumpySVC 推理，
+不再需要 sklearn。导出前会在随机生成的切割块上与 sklearn 的预测逐一核对
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from .const import Model_Dir
+from .feature import FeatureExtractor
+from .svm import NumpySVC
+from .classifier import get_joblib, Model_Format_Version, get_model_files
+
+__all__ = ["compact_filename","convert","export_numpy",]
+
+
+def compact_filename(alg, detail, ext=".joblib"):
+    parts = [alg, "model", "f%s" % detail["feature"]]
+    if detail["level"]:
+        parts.append("l%s" % detail["level"])
+    parts.append("v%d" % Model_Format_Version)
+    return ".".join(parts) + ext
+
+
+def _timeit(func, *args, **kwargs):
+    t0 = time.perf_counter()
+    res = func(*args, **kwargs)
+    return res, time.perf_counter() - t0
+
+
+def convert(alg):
+    """ 转换一个模型，返回 (新文件路径, 压缩模型加载耗时, 新模型加载耗时) """
+    joblib = get_joblib()
+    detail = get_model_files()[alg]
+    clf, before = _timeit(joblib.load, detail["source"])
+    path = os.path.join(Model_Dir, compact_filename(alg, detail))
+    joblib.dump(clf, path, compress=0)
+    _, after = _timeit(joblib.load, path)
+    return path, before, after
+
+
+def _check_corpus(feature, n=2000, size=22, seed=0):
+    """ 不同墨迹密度的随机切割块 """
+    rs = np.random.RandomState(seed)
+    density = rs.uniform(0.05, 0.5, n)
+    segs = rs.rand(n, size, size) >= density[:,None,None] # True 为白
+    return np.array([feature(seg) for seg in segs])
+
+
+def export_numpy(alg):
+    """ 导出 SVC 参数，核对预测一致后写入 .npz，返回 (路径, 核对样本数) """
+    detail = get_model_files()[alg]
+    clf = get_joblib().load(detail["source"])
+    if not hasattr(clf, "support_vectors_"):
+        raise TypeError("%s is not an SVC model" % alg)
+    engine = NumpySVC.from_sklearn(clf)
+
+    feature = FeatureExtractor.get_feature(detail["feature"], detail["level"] or "")
+    X = _check_corpus(feature)
+    expected = clf.predict(X)
+    got = engine.predict(X)
+    mismatch = int((expected != got).sum())
+    if mismatch:
+        raise ValueError("NumpySVC disagrees with sklearn on %d/%d samples" % (mismatch, len(X)))
+
+    path = os.path.join(Model_Dir, compact_filename(alg, detail, ".npz"))
+    engine.save(path)
+    return path, len(X)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python3 -m captcha.convert", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("algs", nargs="*", help="algorithms to convert, default all")
+    parser.add_argument("--numpy", action="store_true", help="export SVC parameters for NumpySVC")
+    args = parser.parse_args(argv)
+
+    algs = args.algs or sorted(get_model_files())
+    if args.numpy:
+        for alg in algs:
+            path, n = export_numpy(alg)
+            print("%-12s checked %d samples  %s" % (alg, n, os.path.basename(path)))
+        return
+    for alg in algs:
+        path, before, after = convert(alg)
+        print("%-12s %7.1f ms -> %7.1f ms  %s" % (alg, before * 1e3, after * 1e3, os.path.basename(path)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# filename: captcha/dataset.py
+
+import os
+import threading
+import numpy as np
+from .bitmap import Bitmap
+from .const import Dataset_Dir
+from .util import mkdir
+
+__all__ = ["CaptchaDataset",]
+
+
+class CaptchaDataset(object):
+    """ 服务器确认过的验证码切割块，用于重新训练模型
+
+        每个切割块为一条定长记录：1 字节 ASCII 标签 + 按位打包的切割块（22x22 为 61 字节），
+        追加写入 directory/segments.HxW.bin，一万张验证码约 2.4 MB
+    """
+
+    def __init__(self, directory=Dataset_Dir, shape=(22,22)):
+        self.directory = directory
+        self.shape = tuple(shape)
+        self.written = 0
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, "segments.%dx%d.bin" % self.shape)
+
+    @property
+    def record_size(self):
+        height, width = self.shape
+        return 1 + (height * width + 7) // 8
+
+    def add(self, result):
+        """ 记录一个校验通过的 CaptchaRecognitionResult，返回写入的切割块数 """
+        records = []
+        for seg, ch in zip(result.segs, result.code):
+            if not isinstance(seg, Bitmap):
+                seg = Bitmap.from_array(np.asarray(seg))
+            if seg.shape != self.shape:
+                continue
+            records.append(ch.encode("ascii") + seg.bits.tobytes())
+        if records:
+            with self._lock:
+                mkdir(self.directory)
+                with open(self.path, "ab") as fp:
+                    fp.write(b"".join(records))
+                self.written += len(records)
+        return len(records)
+
+    def load(self):
+        """ 返回 (labels, ink)，labels 为字符数组，ink 为 (n, H, W) 的 0/1 uint8 数组，黑为 1 """
+        height, width = self.shape
+        if not os.path.exists(self.path):
+            return np.zeros(0, dtype="U1"), np.zeros((0, height, width), dtype=np.uint8)
+        raw = np.fromfile(self.path, dtype=np.uint8)
+        raw = raw[:raw.size - raw.size % self.record_size].reshape((-1, self.record_size)) # 忽略写了一半的记录
+        labels = raw[:,0].tobytes().decode("ascii")
+        ink = np.unpackbits(raw[:,1:], axis=1, count=height*width).reshape((-1, height, width))
+        return np.array(list(labels), dtype="U1"), ink
+
+    def __len__(self):
+        if not os.path.exists(self.path):
+            return 0
+        return os.path.getsize(self.path) // self.record_size
@@ -19,6 +19,8 @@ __all__ = [
         "ImageModeError",
         "ImageBlocksNumException",
 
+    "CaptchaRejectedException",
+
     "UserInputException",
         "NotInCoursePlanException",
         "UnsupportedCodingError",
@@ -95,6 +97,14 @@ class ImageBlocksNumException(ImageProcessorException):
     """ 分割块数量应该的介于 [1,4] """
 
 
+class CaptchaRejectedException(AutoElectiveException):
+    """ 识别置信度低于阈值，不提交，直接换一张验证码 """
+
+    def __init__(self, *args, **kwargs):
+        self.result = kwargs.pop("result", None)
+        super().__init__(*args, **kwargs)
+
+
 class UserInputException(AutoElectiveException):
     """ csv 与 config.ini 等输入数据有误 """
 
@@ -2,9 +2,11 @@
 # -*- coding: utf-8 -*-
 # filename: captcha/feature.py
 
-from functools import partial
+from functools import partial, lru_cache
 from PIL import Image
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from .bitmap import Bitmap
 from .util import NoInstance
 from .exceptions import FeatureCodeError
 
@@ -12,6 +14,10 @@ __all__ = ["FeatureExtractor",]
 
 
 class FeatureExtractor(object, metaclass=NoInstance):
+    """ 特征提取，img 可为 Image、bool 数组（True 为白）或 Bitmap
+
+        特征向量使用能容纳其最大值的最小无符号整数类型，例如 feature3 (level=1) 为 uint8
+    """
 
     @staticmethod
     def get_feature(feature, level=""):
@@ -34,32 +40,66 @@ class FeatureExtractor(object, metaclass=NoInstance):
             func = partial(Feature_Map[feature], level=level)
         return func
 
+    @staticmethod
+    def _binarize(img):
+        """ 转为反相后的 0/1 uint8 数组，黑为 1 """
+        if isinstance(img, Bitmap):
+            return img.ink() # 打包时已反相
+        if isinstance(img, np.ndarray):
+            ary = img
+        else:
+            ary = np.array(img.convert("1"))
+        if ary.dtype == np.bool_:
+            return (~ary).view(np.uint8) # 反相
+        return 1 - ary
+
+    @staticmethod
+    def _compact(ary, maxval):
+        """ 转为能容纳 maxval 的最小无符号整数类型 """
+        return ary.astype(np.min_scalar_type(maxval), copy=False)
+
+    @staticmethod
+    def _box_sum(ary, level):
+        """ 利用积分图计算所有完整的 (2l+1)^2 窗口之和 """
+        s = 2 * level + 1
+        height, width = ary.shape
+        sat = np.zeros((height+1, width+1), dtype=np.int32)
+        np.cumsum(ary, axis=0, out=sat[1:,1:])
+        np.cumsum(sat[1:,1:], axis=1, out=sat[1:,1:])
+        return sat[s:,s:] - sat[:-s,s:] - sat[s:,:-s] + sat[:-s,:-s]
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _weight(level):
+        """ feature5 的权重矩阵，按 level 缓存，只读 """
+        l = level
+        s = 2 * l + 1
+        idx = np.arange(s)
+        ring = np.minimum(idx, s - 1 - idx) # 到边缘的距离
+        depth = np.minimum.outer(ring, ring)
+        weight = np.zeros((s,s), dtype=int)
+        for k in range(l+1):
+            weight[depth >= k] += (k + 1)**2 # 等比数列
+        weight.flags.writeable = False
+        return weight
+
     @staticmethod
     def feature1(img):
         """ 遍历全部像素 """
-        ary = np.array(img.convert("1"))
-        ary = 1 - ary # 反相
+        ary = __class__._binarize(img)
         return ary.flatten()
 
     @staticmethod
     def feature2(img):
         """ feature2 降维 """
-        ary = np.array(img.convert("1"))
-        ary = 1 - ary # 反相
-        return np.concatenate([ary.sum(axis=0), ary.sum(axis=1)])
+        ary = __class__._binarize(img)
+        return __class__._compact(np.concatenate([ary.sum(axis=0), ary.sum(axis=1)]), max(ary.shape))
 
     @staticmethod
     def feature3(img, level):
         """ 考虑临近像素的遍历 """
-        ary = np.array(img.convert("1"))
-        ary = 1 - ary # 反相
-        l = level
-        featureVector = []
-        for i in range(l, ary.shape[0]-l):
-            for j in range(l, ary.shape[1]-l):
-                i1,i2,j1,j2 = i-l, i+l+1, j-l, j+l+1
-                featureVector.append(np.sum(ary[i1:i2, j1:j2])) # sum block
-        return np.array(featureVector)
+        ary = __class__._binarize(img)
+        return __class__._compact(__class__._box_sum(ary, level), (2*level+1)**2).flatten() # sum block
 
     @staticmethod
     def feature4(img, level):
@@ -67,8 +107,8 @@ class FeatureExtractor(object, metaclass=NoInstance):
         ary = __class__.feature3(img, level)
         s = int(np.sqrt(ary.size))
         assert s**2 == ary.size # 确保为方
-        ary.resize((s,s))
-        return np.concatenate([ary.sum(axis=0), ary.sum(axis=1)])
+        ary = ary.reshape((s,s))
+        return __class__._compact(np.concatenate([ary.sum(axis=0), ary.sum(axis=1)]), s * (2*level+1)**2)
 
     @staticmethod
     def feature5(img, level):
@@ -76,22 +116,13 @@ class FeatureExtractor(object, metaclass=NoInstance):
 
             weight 矩阵例如：
             array([[1, 1, 1, 1, 1],
-                   [1, 2, 2, 2, 1],
-                   [1, 2, 3, 2, 1],
-                   [1, 2, 2, 2, 1],
+                   [1, 5, 5, 5, 1],
+                   [1, 5, 14, 5, 1],
+                   [1, 5, 5, 5, 1],
                    [1, 1, 1, 1, 1]])
         """
-        ary = np.array(img.convert("1"))
-        ary = 1 - ary # 反相
-        l = level
-        s = size = 2 * l + 1
-        weight = np.zeros(s**2,dtype=np.int).reshape((s,s))
-        for k in range(l+1):
-            mask = np.array([k<=i<s-k and k<=j<s-k for i in range(s) for j in range(s)]).reshape((s,s))
-            weight[mask] += (k + 1)**2 # 等比数列
-        featureVector = []
-        for i in range(l, ary.shape[0]-l):
-            for j in range(l, ary.shape[1]-l):
-                i1,i2,j1,j2 = i-l, i+l+1, j-l, j+l+1
-                featureVector.append(np.sum(ary[i1:i2, j1:j2]*weight)) # sum block with weight
-        return np.array(featureVector)
+        ary = __class__._binarize(img)
+        s = 2 * level + 1
+        weight = __class__._weight(level)
+        windows = sliding_window_view(ary, (s,s))
+        return __class__._compact(np.tensordot(windows, weight, axes=2), weight.sum()).flatten() # sum block with weight
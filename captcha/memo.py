@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# filename: captcha/memo.py
+
+import threading
+from collections import OrderedDict
+import numpy as np
+from .bitmap import Bitmap
+
+__all__ = ["SegmentCache",]
+
+
+class SegmentCache(object):
+    """ 切割块 -> 预测字符 的 LRU 缓存
+
+        键为归一化后切割块（22x22 Bitmap 或 bool 数组）按位打包后的字节，
+        更换模型后须调用 clear 使缓存失效
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(seg):
+        if isinstance(seg, Bitmap):
+            return seg.key()
+        return seg.shape, np.packbits(~seg).tobytes() # 与 Bitmap.key 一致
+
+    def get(self, key):
+        with self._lock:
+            ch = self._data.get(key)
+            if ch is None:
+                self.misses += 1
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+            return ch
+
+    def put(self, key, ch):
+        with self._lock:
+            self._data[key] = ch
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+            }
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# filename: captcha/metrics.py
+
+"""
+识别流程各阶段的耗时统计
+
+    t = metrics.start()
+    ...                         # decode
+    t = metrics.lap("decode", t)
+    ...                         # denoise
+    t = metrics.lap("denoise8", t)
+
+未启用时 start 返回 None，lap 直接返回，开销只有一次属性判断
+"""
+
+import bisect
+import threading
+from time import perf_counter
+
+__all__ = ["Histogram","StageMetrics","metrics",]
+
+
+class Histogram(object):
+    """ 对数分桶的耗时直方图，内存固定，百分位为所在桶的上界
+
+        桶的范围为 1us ~ 10s，每 10 倍划分 20 个桶，相对误差约 12%
+    """
+    Edges = tuple(10 ** (k / 20) for k in range(-120, 21))
+
+    def __init__(self):
+        self.counts = [0] * (len(self.__class__.Edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.__class__.Edges, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q / 100 * self.count
+        acc = 0
+        for idx, n in enumerate(self.counts):
+            acc += n
+            if acc >= rank and n > 0:
+                if idx >= len(self.__class__.Edges):
+                    return self.max
+                return min(self.__class__.Edges[idx], self.max)
+        return self.max
+
+    def summary(self):
+        """ 单位 ms """
+        return {
+            "count": self.count,
+            "mean": self.total / self.count * 1e3 if self.count else 0.0,
+            "p50": self.percentile(50) * 1e3,
+            "p90": self.percentile(90) * 1e3,
+            "p99": self.percentile(99) * 1e3,
+            "max": self.max * 1e3,
+        }
+
+
+class StageMetrics(object):
+    """ 按阶段记录耗时
+
+        enabled     是否记录，默认关闭
+        callback    可选的回调 callback(stage, seconds)，用于接入外部监控
+    """
+
+    def __init__(self, enabled=False, callback=None):
+        self.enabled = enabled
+        self.callback = callback
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        return perf_counter() if self.enabled else None
+
+    def lap(self, stage, t0):
+        """ 记录从 t0 到现在的耗时，返回新的起点 """
+        if t0 is None:
+            return None
+        now = perf_counter()
+        self.record(stage, now - t0)
+        return now
+
+    def record(self, stage, seconds):
+        with self._lock:
+            hist = self._histograms.get(stage)
+            if hist is None:
+                hist = self._histograms[stage] = Histogram()
+            hist.add(seconds)
+        if self.callback is not None:
+            self.callback(stage, seconds)
+
+    def summary(self):
+        with self._lock:
+            return {stage: hist.summary() for stage, hist in self._histograms.items()}
+
+    def format_summary(self):
+        parts = []
+        for stage, s in self.summary().items():
+            parts.append("%s n=%d p50=%.2fms p99=%.2fms" % (stage, s["count"], s["p50"], s["p99"]))
+        return "; ".join(parts)
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+metrics = StageMetrics()
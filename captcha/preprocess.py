@@ -4,7 +4,9 @@
 
 import os
 from PIL import Image
+import numpy as np
 from .util import NoInstance
+from .metrics import metrics
 from .exceptions import ImageModeError, ImageBlocksNumException
 
 __all__ = ["ImageProcessor",]
@@ -13,14 +15,25 @@ __all__ = ["ImageProcessor",]
 class ImageProcessor(object, metaclass=NoInstance):
     """ 图像处理类，提供验证码的降噪和切割
 
+        img 可以是 mode 为 "1" 的 Image，也可以是 bool 数组（True 为白），传入数组时返回值也为数组。
+        Engine（或 engine 参数）选择实现，对 Image 和数组都有效：
+        "numpy" 全程以数组处理，"pil" 转为 Image 后逐像素处理，用于核对与排查
+
         public  static method   denoise8
                                 denoise24
                                 crop
 
         private static method   _denoise
+                                _denoise_pil
+                                _denoise_array
+                                _neighbour_count
                                 _search_blocks
+                                _label_blocks
                                 _split_spans
                                 _crop
+                                _crop_array
+                                _crop_any
+                                _check_mode
     """
     PX_White = 255
     PX_Black = 0
@@ -34,11 +47,39 @@ class ImageProcessor(object, metaclass=NoInstance):
 
     Min_Block_Size = 9
 
+    Engine = "numpy" # "numpy" 为数组实现，"pil" 为逐像素的原始实现
+
     @staticmethod
-    def _denoise(img, steps, threshold, repeat):
-        """ 去噪函数模板 """
-        if not img.mode == "1":
+    def _check_mode(img):
+        if isinstance(img, np.ndarray):
+            if not img.dtype == np.bool_:
+                raise ImageModeError
+        elif not img.mode == "1":
             raise ImageModeError
+
+    @staticmethod
+    def _denoise(img, steps, threshold, repeat, engine=None):
+        """ 去噪函数模板 """
+        __class__._check_mode(img)
+        engine = engine or __class__.Engine
+        if isinstance(img, np.ndarray):
+            if engine == "pil":
+                return np.array(__class__._denoise_pil(Image.fromarray(img), steps, threshold, repeat))
+            elif engine == "numpy":
+                return __class__._denoise_array(img, steps, threshold, repeat)
+            else:
+                raise ValueError("unknown engine %r" % engine)
+        if engine == "pil":
+            return __class__._denoise_pil(img, steps, threshold, repeat)
+        elif engine == "numpy":
+            ary = __class__._denoise_array(np.array(img), steps, threshold, repeat)
+            return Image.fromarray(ary)
+        else:
+            raise ValueError("unknown engine %r" % engine)
+
+    @staticmethod
+    def _denoise_pil(img, steps, threshold, repeat):
+        """ 逐像素去噪，直接修改 img """
         for _ in range(repeat):
             for j in range(img.width):
                 for i in range(img.height):
@@ -59,14 +100,63 @@ class ImageProcessor(object, metaclass=NoInstance):
         return img
 
     @staticmethod
-    def denoise8(img, steps=Steps8, threshold=6, repeat=2):
+    def _neighbour_count(mask, steps, pad):
+        """ 对 mask 按 steps 平移求和，边界外取 pad """
+        height, width = mask.shape
+        r = max(max(abs(x), abs(y)) for x, y in steps)
+        padded = np.pad(mask, r, mode="constant", constant_values=pad)
+        count = np.zeros((height, width), dtype=np.uint8)
+        for x, y in steps:
+            count += padded[r+x:r+x+height, r+y:r+y+width]
+        return count
+
+    @staticmethod
+    def _denoise_array(ary, steps, threshold, repeat):
+        """ 数组实现的去噪，输入/输出为 bool 数组（True 为白）
+
+            与 _denoise_pil 的输出逐像素一致。原实现按列优先顺序扫描并原地修改，
+            先扫描到的邻居变白后会计入后续像素的计数，因此分两步：
+                1. 按原图统计，计数已达阈值的像素必然变白
+                2. 对于计数加上“先扫描到的黑色邻居”才可能达到阈值的少量像素，
+                   按扫描顺序逐个补判
+        """
+        white = np.array(ary, dtype=np.bool_)
+        height, width = white.shape
+        before = tuple((x, y) for x, y in steps if y < 0 or (y == 0 and x < 0))
+        for _ in range(repeat):
+            black = ~white
+            count = __class__._neighbour_count(white, steps, True) # 边界外视为白
+            flip = black & (count >= threshold)
+            if before:
+                bound = count + __class__._neighbour_count(black, before, False)
+                pending = black & ~flip & (bound >= threshold)
+                for j, i in zip(*np.nonzero(pending.T)): # 列优先
+                    c = int(count[i,j])
+                    for x, y in before:
+                        i2 = i + x
+                        j2 = j + y
+                        if 0 <= j2 < width and 0 <= i2 < height and flip[i2,j2]:
+                            c += 1
+                    if c >= threshold:
+                        flip[i,j] = True
+            white |= flip
+        return white
+
+    @staticmethod
+    def denoise8(img, steps=Steps8, threshold=6, repeat=2, engine=None):
         """ 考虑外一周的降噪 """
-        return __class__._denoise(img, steps, threshold, repeat)
+        t0 = metrics.start()
+        img = __class__._denoise(img, steps, threshold, repeat, engine)
+        metrics.lap("denoise8", t0)
+        return img
 
     @staticmethod
-    def denoise24(img, steps=Steps24, threshold=20, repeat=2):
+    def denoise24(img, steps=Steps24, threshold=20, repeat=2, engine=None):
         """ 考虑外两周的降噪 """
-        return __class__._denoise(img, steps, threshold, repeat)
+        t0 = metrics.start()
+        img = __class__._denoise(img, steps, threshold, repeat, engine)
+        metrics.lap("denoise24", t0)
+        return img
 
     @staticmethod
     def _search_blocks(img, steps=Steps8, min_block_size=Min_Block_Size):
@@ -116,6 +206,64 @@ class ImageProcessor(object, metaclass=NoInstance):
             raise ImageBlocksNumException
         return blocks
 
+    @staticmethod
+    def _label_blocks(ary, steps=Steps8, min_block_size=Min_Block_Size):
+        """ 游程扫描 + 并查集的连通块标记，输入为 bool 数组（True 为白）
+
+            按列切分出黑色游程，相邻两列的游程在 steps 的连通性下重叠则合并。
+            只返回每个块的 (left, right, size)，顺序与 _search_blocks 的发现顺序一致
+        """
+        if set(steps) == set(__class__.Steps8):
+            reach = 1
+        elif set(steps) == set(__class__.Steps4):
+            reach = 0
+        else:
+            raise ValueError("only Steps8/Steps4 connectivity is supported")
+
+        height, width = ary.shape
+        padded = np.zeros((width, height+2), dtype=np.int8)
+        padded[:,1:-1] = ~ary.T # 列优先，首尾补白
+        diff = np.diff(padded, axis=1)
+        cols, starts = np.nonzero(diff == 1)
+        ends = np.nonzero(diff == -1)[1] - 1
+        cols, starts, ends = cols.tolist(), starts.tolist(), ends.tolist()
+
+        parent = list(range(len(cols)))
+
+        def _find(k):
+            while parent[k] != k:
+                parent[k] = parent[parent[k]]
+                k = parent[k]
+            return k
+
+        prevHead = prevTail = curHead = 0 # 上一列 / 当前列游程的下标区间
+        for k, (j, a, b) in enumerate(zip(cols, starts, ends)):
+            if k == 0 or j != cols[k-1]:
+                if k > 0 and j == cols[k-1] + 1:
+                    prevHead, prevTail = curHead, k
+                else:
+                    prevHead = prevTail = k
+                curHead = k
+            for m in range(prevHead, prevTail):
+                if starts[m] <= b + reach and a <= ends[m] + reach:
+                    r1, r2 = _find(k), _find(m)
+                    if r1 != r2:
+                        parent[max(r1,r2)] = min(r1,r2) # 根为扫描顺序最早的游程
+
+        blocks = {}
+        for k, (j, a, b) in enumerate(zip(cols, starts, ends)):
+            root = _find(k)
+            if root in blocks:
+                left, right, size = blocks[root]
+                blocks[root] = (min(left,j), max(right,j), size + b - a + 1)
+            else:
+                blocks[root] = (j, j, b - a + 1)
+
+        blocks = [blocks[root] for root in sorted(blocks) if blocks[root][2] >= min_block_size]
+        if not 1 <= len(blocks) <= 4:
+            raise ImageBlocksNumException
+        return blocks
+
     @staticmethod
     def _split_spans(spans):
         """ 确保 spans 为 4 份 """
@@ -166,11 +314,55 @@ class ImageProcessor(object, metaclass=NoInstance):
         return segs
 
     @staticmethod
-    def crop(img):
-        if not img.mode == "1":
-            raise ImageModeError
-        blocks = __class__._search_blocks(img, steps=__class__.Steps8)
-        spans = [i[1:] for i in blocks]
+    def _crop_array(ary, spans):
+        """ 分割 bool 数组，结果与 _crop 一致 """
+        if not len(spans) == 4:
+            raise ImageBlocksNumException
+        size = ary.shape[0] # height == 22
+        segs = []
+        for left, right in spans:
+            seg = np.ones((size,size), dtype=np.bool_)
+            piece = ary[:, left:right+1]
+            offset = (size - piece.shape[1]) // 2 # 与 Image.paste 一样，超出部分被裁掉
+            src = max(0, -offset)
+            dst = max(0, offset)
+            n = min(piece.shape[1] - src, size - dst)
+            seg[:, dst:dst+n] = piece[:, src:src+n]
+            segs.append(seg)
+        return segs
+
+    @staticmethod
+    def crop(img, engine=None):
+        t0 = metrics.start()
+        segs, spans = __class__._crop_any(img, engine)
+        metrics.lap("crop", t0)
+        return segs, spans
+
+    @staticmethod
+    def _crop_any(img, engine=None):
+        __class__._check_mode(img)
+        engine = engine or __class__.Engine
+        if isinstance(img, np.ndarray):
+            if engine == "pil":
+                segs, spans = __class__._crop_any(Image.fromarray(img), engine)
+                return [ np.array(seg) for seg in segs ], spans
+            elif engine == "numpy":
+                blocks = __class__._label_blocks(img, steps=__class__.Steps8)
+                spans = [i[:2] for i in blocks]
+                spans.sort(key=lambda span: sum(span))
+                spans = __class__._split_spans(spans)
+                segs = __class__._crop_array(img, spans)
+                return segs, spans
+            else:
+                raise ValueError("unknown engine %r" % engine)
+        if engine == "pil":
+            blocks = __class__._search_blocks(img, steps=__class__.Steps8)
+            spans = [i[1:] for i in blocks]
+        elif engine == "numpy":
+            blocks = __class__._label_blocks(np.array(img), steps=__class__.Steps8)
+            spans = [i[:2] for i in blocks]
+        else:
+            raise ValueError("unknown engine %r" % engine)
         spans.sort(key=lambda span: sum(span))
         spans = __class__._split_spans(spans)
         segs = __class__._crop(img, spans)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# filename: captcha/retrain.py
+
+"""
+用 CaptchaDataset 中服务器确认过的切割块重新训练模型，需要 sklearn
+
+    python3 -m captcha.retrain SVM [-f 3] [-l 1] [-c 9] [--numpy]
+
+特征编号与 level 默认沿用 model/ 中的同名模型，新模型保存为 alg.model.fN.lN.cN.xz。
+新模型先写入临时文件，写入成功后，同名算法原有的模型文件（包括 convert 生成的 .v1 文件）
+加上 .时间.bak 后缀保留，再把临时文件改名为新模型。每次备份的文件名都不同，去掉后缀即可回退到任意一次。
+训练前留出 --holdout 比例的切割块，在同一批样本上比较新旧模型的准确率
+"""
+
+import os
+import sys
+import time
+import argparse
+import importlib
+import numpy as np
+from .const import Model_Dir, Dataset_Dir
+from .feature import FeatureExtractor
+from .dataset import CaptchaDataset
+from .classifier import get_joblib, get_model_files
+from .benchmark import load_classifiers
+from .convert import export_numpy
+
+__all__ = ["Estimators","model_filename","build_features","retrain",]
+
+
+# alg -> (模块, 类名, 参数)，SVM 的参数与附带的模型一致
+Estimators = {
+    "SVM":          ("sklearn.svm",       "SVC",                    {"gamma": "auto"}),
+    "KNN":          ("sklearn.neighbors", "KNeighborsClassifier",   {}),
+    "RandomForest": ("sklearn.ensemble",  "RandomForestClassifier", {"n_estimators": 100}),
+}
+
+Compress_Ext = {"xz": ".xz", "bz2": ".bz2", "gzip": ".gz", "zlib": ".z"}
+
+
+def model_filename(alg, feature, level, compress, method="xz"):
+    parts = [alg, "model", "f%s" % feature]
+    if level:
+        parts.append("l%s" % level)
+    parts.append("c%d" % compress)
+    return ".".join(parts) + Compress_Ext[method]
+
+
+def build_features(ink, feature):
+    """ ink 为 (n, H, W) 的 0/1 数组，黑为 1，返回 (n, n_features) 的特征矩阵 """
+    white = ink == 0
+    return np.vstack([ feature(seg) for seg in white ])
+
+
+def make_estimator(alg):
+    if alg not in Estimators:
+        raise ValueError("unknown algorithm %r, choose from %s" % (alg, ", ".join(sorted(Estimators))))
+    module, name, params = Estimators[alg]
+    return getattr(importlib.import_module(module), name)(**params)
+
+
+def _evaluate_current(alg, ink, labels):
+    """ 现有模型在留出样本上的准确率，无法加载时返回 None """
+    clf, _ = load_classifiers([alg]).get(alg, (None, None))
+    if clf is None or isinstance(clf, Exception):
+        return None
+    X = build_features(ink, clf.feature)
+    return float((clf.predict(X) == labels).mean())
+
+
+def _backup_name(file, stamp):
+    """ 不与已有备份重名的 file.stamp.bak """
+    name = "%s.%s.bak" % (file, stamp)
+    n = 1
+    while os.path.exists(os.path.join(Model_Dir, name)):
+        n += 1
+        name = "%s.%s-%d.bak" % (file, stamp, n)
+    return name
+
+
+def _retire(alg):
+    """ 给同名算法的模型文件加上 .时间.bak 后缀，返回 [(原文件名, 备份文件名)] """
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    retired = []
+    for file in sorted(os.listdir(Model_Dir)):
+        if file.startswith(alg + ".model.") and not file.endswith((".bak", ".tmp")):
+            backup = _backup_name(file, stamp)
+            os.rename(os.path.join(Model_Dir, file), os.path.join(Model_Dir, backup))
+            retired.append((file, backup))
+    return retired
+
+
+def retrain(alg, feature=None, level=None, compress=9, method="xz", holdout=0.2,
+            dataset=None, seed=0):
+    dataset = dataset or CaptchaDataset()
+    labels, ink = dataset.load()
+    if len(labels) == 0:
+        raise ValueError("dataset %s is empty" % dataset.path)
+
+    current = get_model_files().get(alg)
+    if feature is None:
+        if current is None:
+            raise ValueError("no %s model in %s, specify the feature" % (alg, Model_Dir))
+        feature, level = current["feature"], current["level"]
+    extractor = FeatureExtractor.get_feature(feature, level or "")
+
+    order = np.random.RandomState(seed).permutation(len(labels))
+    nTest = int(len(labels) * holdout)
+    test, train = order[:nTest], order[nTest:]
+
+    t0 = time.perf_counter()
+    X = build_features(ink, extractor)
+    t1 = time.perf_counter()
+    clf = make_estimator(alg)
+    clf.fit(X[train], labels[train])
+    t2 = time.perf_counter()
+
+    report = {
+        "samples": len(labels),
+        "train": len(train),
+        "holdout": nTest,
+        "feature_time": t1 - t0,
+        "fit_time": t2 - t1,
+        "accuracy": float((clf.predict(X[test]) == labels[test]).mean()) if nTest else None,
+        "current_accuracy": _evaluate_current(alg, ink[test], labels[test]) if nTest else None,
+    }
+
+    filename = model_filename(alg, feature, level, compress, method)
+    path = os.path.join(Model_Dir, filename)
+    # 写入失败时原有模型保持不动
+    try:
+        get_joblib().dump(clf, path + ".tmp", compress=(method, compress))
+    except BaseException:
+        if os.path.exists(path + ".tmp"):
+            os.remove(path + ".tmp")
+        raise
+    report["retired"] = _retire(alg)
+    os.replace(path + ".tmp", path)
+    report["file"] = filename
+    get_model_files(refresh=True)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python3 -m captcha.retrain", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("alg", choices=sorted(Estimators))
+    parser.add_argument("-f", "--feature", help="feature number, default the current model's")
+    parser.add_argument("-l", "--level", default="", help="feature level for features 3-5")
+    parser.add_argument("-c", "--compress", type=int, default=9, help="compression level 1-9")
+    parser.add_argument("--method", choices=sorted(Compress_Ext), default="xz")
+    parser.add_argument("--holdout", type=float, default=0.2, help="fraction held out for evaluation")
+    parser.add_argument("--dataset", default=Dataset_Dir, help="CaptchaDataset directory")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--numpy", action="store_true", help="also export the new SVC for NumpySVC")
+    args = parser.parse_args(argv)
+
+    report = retrain(args.alg, args.feature, args.level, args.compress, args.method,
+                     args.holdout, CaptchaDataset(args.dataset), args.seed)
+    print("%d segments, trained on %d in %.1fs (features %.1fs)" % (
+        report["samples"], report["train"], report["fit_time"], report["feature_time"]))
+    if report["accuracy"] is not None:
+        current = report["current_accuracy"]
+        print("holdout accuracy %.4f, current model %s" % (
+            report["accuracy"], "n/a" if current is None else "%.4f" % current))
+    print("saved %s" % report["file"])
+    for file, backup in report["retired"]:
+        print("retired %s -> %s" % (file, backup))
+    if args.numpy:
+        path, n = export_numpy(args.alg)
+        print("exported %s, checked %d samples" % (os.path.basename(path), n))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# filename: captcha/selection.py
+
+"""
+在带标签的验证码上比较 model/ 中的所有模型，写出分类器选择策略
+
+    python3 -m captcha.selection --dataset captcha/dataset/ [--budget 5]
+    python3 -m captcha.selection --dry-run [-n 500]
+
+--dataset 使用 CaptchaDataset 中服务器确认过的切割块，每 4 个为一张验证码，统计特征提取与预测的延迟。
+不给 --dataset 时使用 synthetic 生成的验证码，统计端到端（解码到预测）延迟，只能配合 --dry-run 比较速度：
+生成的验证码与 elective 的差别很大，附带的模型在上面的准确率接近 0，据此选出的只是最快的模型。
+所有模型的准确率都低于 Min_Accuracy 时同样不写出策略
+
+策略包括 Pareto 前沿（没有其他模型同时更快、更准）和选中的模型：p99 不超过 --budget 毫秒的模型中
+准确率最高的一个，未给出预算时直接取准确率最高的，准确率相同时取 p99 更低的。
+结果写入 model/policy.json，CaptchaRecognizer 创建时据此加载分类器
+"""
+
+import os
+import sys
+import time
+import argparse
+from .const import Model_Policy_JSON
+from .dataset import CaptchaDataset
+from .synthetic import CaptchaGenerator
+from .benchmark import load_classifiers, bench_classifier, summarize
+from .util import json_dump
+
+__all__ = ["evaluate_dataset","pareto_front","select","build_policy","policy_error",]
+
+Min_Accuracy = 0.05
+
+
+def evaluate_dataset(clf, labels, ink, size=4):
+    """ 切割块按 size 个一组还原为验证码 """
+    white = ink == 0
+    total = []
+    correct = charsCorrect = 0
+    n = len(labels) // size
+    for idx in range(n):
+        segs = white[idx*size:(idx+1)*size]
+        label = labels[idx*size:(idx+1)*size]
+        t0 = time.perf_counter()
+        chars, _ = clf.classify(segs)
+        total.append(time.perf_counter() - t0)
+        hits = sum(str(a) == b for a, b in zip(chars, label))
+        correct += hits == size
+        charsCorrect += hits
+    return {
+        "end_to_end": summarize(total),
+        "throughput": n / sum(total) if total else 0.0,
+        "accuracy": correct / n if n else 0.0,
+        "char_accuracy": charsCorrect / (n * size) if n else 0.0,
+    }
+
+
+def pareto_front(entries):
+    """ entries 为 {alg: {"p50", "p99", "accuracy"}}，返回按 p99 升序排列的前沿 """
+    front = []
+    best = -1.0
+    for alg, entry in sorted(entries.items(), key=lambda item: (item[1]["p99"], -item[1]["accuracy"])):
+        if entry["accuracy"] > best:
+            front.append(alg)
+            best = entry["accuracy"]
+    return front
+
+
+def select(entries, budget=None):
+    candidates = { alg: entry for alg, entry in entries.items()
+                   if budget is None or entry["p99"] <= budget }
+    if not candidates:
+        return None
+    return min(candidates, key=lambda alg: (-candidates[alg]["accuracy"], candidates[alg]["p99"]))
+
+
+def build_policy(n=500, seed=0, budget=None, dataset=None):
+    if dataset is not None:
+        labels, ink = dataset.load()
+        corpus = "dataset"
+        evaluate = lambda clf: evaluate_dataset(clf, labels, ink)
+    else:
+        samples = CaptchaGenerator(seed=seed).generate_many(n)
+        corpus = "synthetic"
+        evaluate = lambda clf: bench_classifier(clf, samples)
+
+    entries = {}
+    errors = {}
+    for alg, (clf, detail) in load_classifiers().items():
+        if isinstance(clf, Exception):
+            errors[alg] = "%s: %s" % (clf.__class__.__name__, clf)
+            continue
+        res = evaluate(clf)
+        entries[alg] = {
+            "file": os.path.basename(detail["path"]),
+            "feature": detail["feature"],
+            "level": detail["level"],
+            "p50": res["end_to_end"]["p50"] if res["end_to_end"] else float("inf"),
+            "p99": res["end_to_end"]["p99"] if res["end_to_end"] else float("inf"),
+            "accuracy": res["accuracy"],
+            "char_accuracy": res["char_accuracy"],
+        }
+
+    return {
+        "selected": select(entries, budget),
+        "budget_ms": budget,
+        "pareto": pareto_front(entries),
+        "corpus": corpus,
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "models": entries,
+        "errors": errors,
+    }
+
+
+def policy_error(policy):
+    """ 策略不可信时返回原因，否则返回 None """
+    if policy["corpus"] != "dataset":
+        return "models were compared on %s captchas, use --dataset to write a policy" % policy["corpus"]
+    accuracies = [ entry["accuracy"] for entry in policy["models"].values() ]
+    if not accuracies or max(accuracies) < Min_Accuracy:
+        return "no model reaches %.2f captcha accuracy on the dataset" % Min_Accuracy
+    if policy["selected"] is None:
+        return "no model fits the budget of %.3f ms" % policy["budget_ms"]
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python3 -m captcha.selection", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", type=int, default=500, help="number of synthetic captchas")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--budget", type=float, help="p99 latency budget in ms")
+    parser.add_argument("--dataset", help="evaluate on a CaptchaDataset directory instead of synthetic captchas")
+    parser.add_argument("-o", "--output", default=Model_Policy_JSON, help="where to write the policy")
+    parser.add_argument("--dry-run", action="store_true", help="print the policy without writing it")
+    args = parser.parse_args(argv)
+
+    dataset = CaptchaDataset(args.dataset) if args.dataset else None
+    policy = build_policy(args.n, args.seed, args.budget, dataset)
+    for alg, entry in sorted(policy["models"].items()):
+        print("%-12s f%s  p50 %7.3f  p99 %7.3f ms  accuracy %.3f  char %.3f%s" % (
+            alg, entry["feature"], entry["p50"], entry["p99"], entry["accuracy"], entry["char_accuracy"],
+            "  pareto" if alg in policy["pareto"] else ""))
+    for alg, error in sorted(policy["errors"].items()):
+        print("%-12s error: %s" % (alg, error))
+    print("selected %s" % policy["selected"])
+    if args.dry_run:
+        return
+    error = policy_error(policy)
+    if error is not None:
+        print("%s, policy not written" % error)
+        return 1
+    json_dump(policy, args.output, indent=2)
+    print("saved %s" % args.output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# filename: captcha/service.py
+
+"""
+多进程验证码识别服务
+
+识别是 CPU 密集的，受 GIL 限制，同一进程内多个会话同时识别只能用到一个核。
+CaptchaService 维护一组预先加载好模型的工作进程，submit 返回 Future：
+
+    service = CaptchaService(workers=4).warmup()
+    future = service.submit(img_bytes)
+    code = future.result()
+
+工作进程使用与创建服务时主进程 recognizer 相同的分类器（包括 set_classifier 换上的 Ensemble），
+也可以用 classifier 指定名称
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor, wait
+
+__all__ = ["CaptchaService",]
+
+
+def _init_worker(mmap_mode, reject_threshold, classifier):
+    from . import recognizer
+    from .classifier import ClassifierMixin, get_classifier
+    ClassifierMixin.Mmap_Mode = mmap_mode # 同一台机器上的工作进程共享模型内存
+    recognizer.Reject_Threshold = reject_threshold
+    # 按名称重新创建：spawn 启动的进程没有主进程的分类器，fork 继承的 Ensemble 线程池在子进程中没有线程
+    recognizer.set_classifier(get_classifier(classifier))
+    recognizer.warmup()
+
+
+def _ping():
+    return os.getpid()
+
+
+def _solve(imgBytes):
+    from . import recognizer
+    return recognizer.recognize(imgBytes, capture=False).code
+
+
+class CaptchaService(object):
+    """ workers 默认为 CPU 核数，异常（如 ImageBlocksNumException）经 Future 原样抛出
+
+        classifier 为分类器名称（见 classifier.get_classifier），默认为主进程 recognizer 当前的分类器
+    """
+
+    def __init__(self, workers=None, mmap_mode="r", reject_threshold=0.0, classifier=None):
+        if classifier is None:
+            from . import recognizer
+            classifier = recognizer.clf.Algorithm
+        self.workers = workers or os.cpu_count() or 1
+        self.classifier = classifier
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_init_worker,
+            initargs=(mmap_mode, reject_threshold, classifier),
+        )
+
+    def warmup(self):
+        """ 启动全部工作进程并加载模型 """
+        wait([ self._pool.submit(_ping) for _ in range(self.workers * 2) ])
+        return self
+
+    def submit(self, imgBytes):
+        return self._pool.submit(_solve, imgBytes)
+
+    def solve(self, imgBytes, timeout=None):
+        return self.submit(imgBytes).result(timeout)
+
+    def map(self, imgBytesList, timeout=None):
+        """ 返回识别结果的迭代器，任一失败时抛出异常 """
+        return self._pool.map(_solve, imgBytesList, timeout=timeout, chunksize=1)
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# filename: captcha/sink.py
+
+import os
+import random
+import threading
+from queue import Queue, Full
+from PIL import Image
+import numpy as np
+from .const import Cache_Dir, Captcha_Cache_Dir
+from .util import mkdir, MD5
+
+__all__ = ["ArtifactSink",]
+
+
+class ArtifactSink(object):
+    """ 验证码调试图片的异步写入器
+
+        识别线程只负责把结果放入有界队列，由后台线程写盘，队列满时直接丢弃。
+
+        sample_rate     采样率，0 ~ 1
+        only_failures   只保存被服务器判为错误的验证码（需调用 capture_failure）
+        max_files       目录内最多保留的文件数，超出时删除最旧的文件
+        max_bytes       目录内最多占用的字节数，超出时删除最旧的文件
+        queue_size      队列长度
+    """
+
+    def __init__(self, directory=Captcha_Cache_Dir, sample_rate=1.0, only_failures=False,
+                 max_files=None, max_bytes=None, queue_size=64):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.only_failures = only_failures
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.written = 0
+        self.dropped = 0
+        self._queue = Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name="ArtifactSink", daemon=True)
+        self._thread.start()
+
+    def capture(self, result):
+        """ 识别完成时调用，only_failures 模式下忽略 """
+        if not self.only_failures:
+            self._submit(result, "")
+
+    def capture_failure(self, result):
+        """ 服务器判定验证码错误时调用，only_failures 模式下才会保存 """
+        if self.only_failures:
+            self._submit(result, "fail.")
+
+    def close(self, timeout=None):
+        """ 写完队列中剩余的图片后退出后台线程 """
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _submit(self, result, tag):
+        if result.raw is None:
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        try:
+            self._queue.put_nowait((result, tag))
+        except Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            result, tag = item
+            try:
+                self._write(result, tag)
+                self._prune()
+            except OSError:
+                self.dropped += 1
+
+    def _abs_cp(self, path):
+        return os.path.abspath(os.path.join(self.directory, path))
+
+    def _write(self, result, tag):
+        if self.directory == Captcha_Cache_Dir:
+            mkdir(Cache_Dir)
+        mkdir(self.directory)
+        imgHash = MD5(result.raw)
+
+        with open(self._abs_cp("%s.%sraw.jpg" % (imgHash, tag)), "wb") as fp:
+            fp.write(result.raw)
+        if result.denoised is not None:
+            Image.fromarray(np.asarray(result.denoised)).save(self._abs_cp("%s.%sdenoised.jpg" % (imgHash, tag)))
+        for idx, (seg, ch) in enumerate(zip(result.segs, result.code)):
+            Image.fromarray(np.asarray(seg)).save(self._abs_cp("%s.%sseg%d.%s.jpg" % (imgHash, tag, idx, ch)))
+        self.written += 1
+
+    def _prune(self):
+        """ 按修改时间删除最旧的文件，直到满足 max_files / max_bytes """
+        if self.max_files is None and self.max_bytes is None:
+            return
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                stat = entry.stat()
+                files.append( (stat.st_mtime, stat.st_size, entry.path) )
+        files.sort()
+        count = len(files)
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if (self.max_files is None or count <= self.max_files) and \
+               (self.max_bytes is None or total <= self.max_bytes):
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            count -= 1
+            total -= size
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# filename: captcha/svm.py
+
+"""
+不依赖 sklearn 的 SVC 推理，参数由 captcha.convert 从训练好的 sklearn.svm.SVC 导出
+
+与 libsvm 的多分类预测一致：对每一对类别 (i, j) 计算决策值，
+大于 0 投给 i，否则投给 j，票数相同时取下标最小的类别
+
+置信度不用得票率（几乎总是全票，误识别也一样），而用决策值的间隔：
+每个类别的得分为它在所有一对一决策中的有符号决策值之和，
+间隔为胜出类别的得分减去其余类别中的最高分，再经 calibration 的 sigmoid 映射到 [0,1]
+"""
+
+import numpy as np
+
+__all__ = ["NumpySVC",]
+
+
+class NumpySVC(object):
+
+    Batch_Size = 64 # 分块计算核矩阵，限制大批量预测时 float64 中间结果的峰值内存
+
+    Fields = ("support_vectors","dual_coef","intercept","n_support","classes",
+              "kernel","gamma","coef0","degree",)
+
+    Calibration = (1.0, 0.0) # 未校准时置信度为 sigmoid(间隔)
+
+    def __init__(self, support_vectors, dual_coef, intercept, n_support, classes,
+                 kernel="rbf", gamma=1.0, coef0=0.0, degree=3):
+        self.support_vectors = np.ascontiguousarray(support_vectors, dtype=np.float64)
+        self.dual_coef = np.asarray(dual_coef, dtype=np.float64)
+        self.intercept = np.asarray(intercept, dtype=np.float64)
+        self.n_support = np.asarray(n_support, dtype=np.int64)
+        self.classes = np.asarray(classes)
+        self.kernel = str(kernel)
+        self.gamma = float(gamma)
+        self.coef0 = float(coef0)
+        self.degree = int(degree)
+
+        nClass = len(self.classes)
+        self._bounds = np.concatenate([[0], np.cumsum(self.n_support)])
+        self._pair_i, self._pair_j = map(np.array, zip(*[
+            (i, j) for i in range(nClass) for j in range(i+1, nClass)
+        ])) if nClass > 1 else (np.zeros(0, int), np.zeros(0, int))
+        self._sv_sq = np.einsum("ij,ij->i", self.support_vectors, self.support_vectors)
+        self._pair_sign = np.zeros((len(self._pair_i), nClass)) # 决策值对各类别得分的贡献
+        self._pair_sign[np.arange(len(self._pair_i)), self._pair_i] = 1
+        self._pair_sign[np.arange(len(self._pair_j)), self._pair_j] = -1
+        self.calibration = self.__class__.Calibration # (scale, offset)，由 captcha.calibrate 拟合
+
+    @classmethod
+    def from_sklearn(cls, clf):
+        """ 从 sklearn.svm.SVC 导出参数，使用 libsvm 内部的符号约定 """
+        return cls(
+            support_vectors=clf.support_vectors_,
+            dual_coef=getattr(clf, "_dual_coef_", clf.dual_coef_),
+            intercept=getattr(clf, "_intercept_", clf.intercept_),
+            n_support=clf.__dict__.get("_n_support", clf.__dict__.get("n_support_")),
+            classes=clf.classes_,
+            kernel=clf.kernel,
+            gamma=clf._gamma,
+            coef0=clf.coef0,
+            degree=clf.degree,
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(**{k: data[k] for k in cls.Fields})
+
+    def save(self, path):
+        data = {k: getattr(self, k) for k in self.__class__.Fields}
+        sv = self.support_vectors
+        if sv.size and sv.min() >= 0 and sv.max() <= 255 and np.array_equal(sv, np.round(sv)):
+            data["support_vectors"] = sv.astype(np.uint8) # 特征为非负整数时无损压缩，加载时还原为 float64
+        with open(path, "wb") as fp:
+            np.savez(fp, **data)
+
+    def _kernel(self, X):
+        dot = X @ self.support_vectors.T
+        if self.kernel == "linear":
+            return dot
+        elif self.kernel == "rbf":
+            sq = dot # 原地计算 |x|^2 + |sv|^2 - 2 x·sv，只保留一个 (n_samples, n_sv) 的数组
+            sq *= -2
+            sq += np.einsum("ij,ij->i", X, X)[:,None]
+            sq += self._sv_sq[None,:]
+            np.maximum(sq, 0, out=sq)
+            sq *= -self.gamma
+            return np.exp(sq, out=sq)
+        elif self.kernel == "poly":
+            return (self.gamma * dot + self.coef0) ** self.degree
+        elif self.kernel == "sigmoid":
+            return np.tanh(self.gamma * dot + self.coef0)
+        else:
+            raise ValueError("unsupported kernel %r" % self.kernel)
+
+    def _batches(self, X):
+        """ 按 Batch_Size 分块，限制大批量预测时 float64 中间结果的峰值内存 """
+        X = np.asarray(X)
+        if X.ndim == 1:
+            X = X.reshape((1,-1))
+        n = self.__class__.Batch_Size
+        for i in range(0, max(X.shape[0], 1), n):
+            yield X[i:i+n]
+
+    def decision_function(self, X):
+        """ 一对一的决策值，形状为 (n_samples, n_classes*(n_classes-1)/2)
+
+            X 可以是任意数值类型（例如 uint8 特征），分块转为 float64 计算
+        """
+        return np.vstack([ self._decision(batch) for batch in self._batches(X) ])
+
+    def _decision(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        K = self._kernel(X)
+        nClass = len(self.classes)
+        # partial[c] = 类别 c 的支持向量对所有 (nClass-1) 个对手的加权和
+        partial = np.empty((nClass, X.shape[0], nClass-1))
+        for c in range(nClass):
+            lo, hi = self._bounds[c], self._bounds[c+1]
+            partial[c] = K[:,lo:hi] @ self.dual_coef[:,lo:hi].T
+        I, J = self._pair_i, self._pair_j
+        return (partial[I,:,J-1] + partial[J,:,I]).T + self.intercept
+
+    def votes(self, X):
+        return np.vstack([ self._votes(batch) for batch in self._batches(X) ])
+
+    def _votes(self, X, dec=None):
+        if dec is None:
+            dec = self._decision(X)
+        nClass = len(self.classes)
+        nSample = dec.shape[0]
+        winner = np.where(dec > 0, self._pair_i, self._pair_j)
+        winner += np.arange(nSample)[:,None] * nClass
+        return np.bincount(winner.ravel(), minlength=nSample*nClass).reshape((nSample, nClass))
+
+    def predict(self, X):
+        return self.classes[self.votes(X).argmax(axis=1)]
+
+    def margins(self, X):
+        """ 返回 (预测类别的下标, 决策值间隔)，类别按投票决定，与 predict 一致 """
+        res = [ self._margins(batch) for batch in self._batches(X) ]
+        return np.concatenate([ idx for idx, _ in res ]), np.concatenate([ m for _, m in res ])
+
+    def _margins(self, X):
+        dec = self._decision(X)
+        idx = self._votes(X, dec).argmax(axis=1)
+        if len(self.classes) < 2:
+            return idx, np.full(len(idx), np.inf)
+        rows = np.arange(len(idx))
+        score = dec @ self._pair_sign
+        winner = score[rows, idx]
+        score[rows, idx] = -np.inf
+        return idx, winner - score.max(axis=1)
+
+    def confidence(self, margin, calibration=None):
+        """ 间隔经 sigmoid(scale * margin + offset) 映射为置信度，默认使用 self.calibration """
+        scale, offset = calibration or self.calibration
+        return 0.5 * (1 + np.tanh(0.5 * (scale * np.asarray(margin, dtype=np.float64) + offset)))
+
+    def predict_confidence(self, X):
+        """ 返回 (预测类别, 置信度) """
+        idx, margin = self.margins(X)
+        return self.classes[idx], self.confidence(margin)
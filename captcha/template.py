@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# filename: captcha/template.py
+
+"""
+按汉明距离匹配模板的分类器，不依赖 sklearn
+
+每个字符保存若干按位打包的 22x22 模板，切割块与全部模板同时做 XOR 和 popcount，
+取距离最近的模板的字符。模板由带标签的切割块生成：同一字符的样本用 k-medians
+（逐位多数表决）聚成 per_class 个模板
+
+    python3 -m captcha.template [--dataset DIR] [--per-class 8] [--holdout 0.2]
+    python3 -m captcha.template --synthetic 2000
+
+生成的模型为 model/Template.model.f1.v1.npz，classifier.Template 加载它。
+留出的切割块上同时给出 --compare 指定的现有模型（默认 SVM）的准确率，两者都按真实标签计算。
+--synthetic 改用 CaptchaGenerator 生成的带标签验证码，只评估不保存：生成的验证码与 elective 的差别很大，
+在上面训练的模板不能用于选课
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from .const import Model_Dir, Dataset_Dir
+from .dataset import CaptchaDataset
+
+__all__ = ["TemplateMatcher",]
+
+
+if hasattr(np, "bitwise_count"): # numpy >= 2.0
+    def _popcount(words):
+        return np.bitwise_count(words)
+else:
+    _Popcount_Table = np.array([ bin(i).count("1") for i in range(256) ], dtype=np.uint8)
+    def _popcount(words):
+        counts = _Popcount_Table[words.view(np.uint8)]
+        return counts.reshape(words.shape + (-1,)).sum(axis=-1, dtype=np.uint8)
+
+
+class TemplateMatcher(object):
+
+    Fields = ("templates","labels","n_bits",)
+
+    def __init__(self, templates, labels, n_bits):
+        self.n_bits = int(n_bits)
+        self.labels = np.asarray(labels)
+        self.templates = self._words(np.asarray(templates, dtype=np.uint8))
+        self._packed = np.asarray(templates, dtype=np.uint8)
+
+    @property
+    def n_bytes(self):
+        return (self.n_bits + 7) // 8
+
+    @staticmethod
+    def _words(packed):
+        """ 补齐到 8 字节的整数倍后视为 uint64，每个样本只需几次 XOR """
+        pad = -packed.shape[1] % 8
+        if pad:
+            packed = np.pad(packed, ((0,0),(0,pad)))
+        return np.ascontiguousarray(packed).view(np.uint64)
+
+    def _pack(self, X):
+        """ X 为 0/1 像素（feature1，每行 n_bits 个）或已按位打包的行（每行 n_bytes 个） """
+        X = np.asarray(X, dtype=np.uint8)
+        if X.ndim == 1:
+            X = X.reshape((1,-1))
+        if X.shape[1] == self.n_bits:
+            X = np.packbits(X, axis=1)
+        elif X.shape[1] != self.n_bytes:
+            raise ValueError("expect %d pixels or %d packed bytes per row, got %d" % (
+                self.n_bits, self.n_bytes, X.shape[1]))
+        return self._words(X)
+
+    def distances(self, X):
+        """ 汉明距离，形状为 (n_samples, n_templates) """
+        words = self._pack(X)
+        return _popcount(words[:,None,:] ^ self.templates[None,:,:]).sum(axis=2, dtype=np.int32)
+
+    def predict(self, X):
+        return self.labels[self.distances(X).argmin(axis=1)]
+
+    def predict_confidence(self, X):
+        """ 返回 (预测类别, 置信度)，置信度为 1 - 最近距离 / 最近的其他字符模板的距离 """
+        dist = self.distances(X)
+        idx = dist.argmin(axis=1)
+        rows = np.arange(len(idx))
+        best = dist[rows, idx]
+        other = np.where(self.labels[None,:] == self.labels[idx][:,None], np.iinfo(np.int32).max, dist).min(axis=1)
+        confidence = np.where(other > 0, 1 - best / np.maximum(other, 1), 0.0)
+        return self.labels[idx], np.clip(confidence, 0.0, 1.0)
+
+    @classmethod
+    def fit(cls, labels, ink, per_class=8, iterations=5, seed=0):
+        """ labels 为字符数组，ink 为 (n, H, W) 的 0/1 数组，黑为 1 """
+        labels = np.asarray(labels)
+        ink = np.asarray(ink, dtype=np.uint8).reshape((len(labels), -1))
+        n_bits = ink.shape[1]
+        rs = np.random.RandomState(seed)
+        templates, templateLabels = [], []
+        for ch in np.unique(labels):
+            samples = ink[labels == ch]
+            k = min(per_class, len(samples))
+            centers = samples[rs.choice(len(samples), k, replace=False)]
+            for _ in range(iterations):
+                matcher = cls(np.packbits(centers, axis=1), np.arange(k), n_bits)
+                assign = matcher.distances(samples).argmin(axis=1)
+                for j in range(k):
+                    members = samples[assign == j]
+                    if len(members):
+                        centers[j] = members.mean(axis=0) >= 0.5 # 逐位多数表决
+            templates.append(np.packbits(centers, axis=1))
+            templateLabels.extend([ch] * k)
+        return cls(np.vstack(templates), np.array(templateLabels), n_bits)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["templates"], data["labels"], int(data["n_bits"]))
+
+    def save(self, path):
+        with open(path, "wb") as fp:
+            np.savez(fp, templates=self._packed, labels=self.labels, n_bits=self.n_bits)
+
+
+def synthetic_segments(n, seed=0):
+    """ 生成 n 张带标签的验证码并切割，丢弃切割块数与标签长度不符的，返回与 CaptchaDataset.load 相同的 (labels, ink) """
+    from . import recognizer
+    from .synthetic import CaptchaGenerator
+    from .exceptions import ImageProcessorException
+    labels, ink = [], []
+    for label, imgBytes in CaptchaGenerator(seed=seed).generate_many(n):
+        try:
+            segs = recognizer._preprocess(imgBytes, capture=False)[1]
+        except ImageProcessorException:
+            continue
+        if len(segs) == len(label) and all( seg.shape == (22,22) for seg in segs ):
+            labels.extend(label)
+            ink.extend( seg.ink() for seg in segs )
+    return np.array(labels, dtype="U1"), np.array(ink, dtype=np.uint8).reshape((-1,22,22))
+
+
+def _evaluate_model(alg, labels, ink):
+    """ 现有模型在切割块上的 (准确率, 每个切割块的耗时)，无法加载时返回 None """
+    from .benchmark import load_classifiers
+    from .retrain import build_features
+    clf, _ = load_classifiers([alg]).get(alg, (None, None))
+    if clf is None or isinstance(clf, Exception):
+        return None
+    t0 = time.perf_counter()
+    predicted = clf.predict(build_features(ink, clf.feature))
+    elapsed = time.perf_counter() - t0
+    return float((np.asarray(predicted) == labels).mean()), elapsed / len(labels)
+
+
+def main(argv=None):
+    from .convert import compact_filename
+    parser = argparse.ArgumentParser(prog="python3 -m captcha.template", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--dataset", default=Dataset_Dir, help="CaptchaDataset directory")
+    parser.add_argument("--per-class", type=int, default=8, help="templates per character")
+    parser.add_argument("--holdout", type=float, default=0.2, help="fraction held out for evaluation")
+    parser.add_argument("--synthetic", type=int, metavar="N", help="evaluate on N generated captchas instead, without saving")
+    parser.add_argument("--compare", default="SVM", help="existing model evaluated on the same holdout, empty to skip")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.synthetic:
+        labels, ink = synthetic_segments(args.synthetic, args.seed)
+        source = "%d generated captchas" % args.synthetic
+    else:
+        labels, ink = CaptchaDataset(args.dataset).load()
+        source = "dataset %s" % args.dataset
+    if len(labels) == 0:
+        print("%s gave no segments" % source)
+        return 1
+    order = np.random.RandomState(args.seed).permutation(len(labels))
+    nTest = int(len(labels) * args.holdout)
+    test, train = order[:nTest], order[nTest:]
+
+    t0 = time.perf_counter()
+    matcher = TemplateMatcher.fit(labels[train], ink[train], args.per_class, seed=args.seed)
+    print("%d templates from %d segments in %.1fs" % (len(matcher.labels), len(train), time.perf_counter() - t0))
+    if nTest:
+        X = np.packbits(ink[test].reshape((nTest, -1)), axis=1)
+        t0 = time.perf_counter()
+        predicted = matcher.predict(X)
+        elapsed = time.perf_counter() - t0
+        print("holdout accuracy %.4f, %.1f us per segment" % (
+            (predicted == labels[test]).mean(), elapsed / nTest * 1e6))
+        if args.compare:
+            res = _evaluate_model(args.compare, labels[test], ink[test])
+            if res is None:
+                print("%s: could not be loaded" % args.compare)
+            else:
+                print("%s holdout accuracy %.4f, %.1f us per segment" % (args.compare, res[0], res[1] * 1e6))
+
+    if args.synthetic:
+        return
+    path = os.path.join(Model_Dir, compact_filename("Template", {"feature": "1", "level": None}, ".npz"))
+    matcher.save(path)
+    print("saved %s" % os.path.basename(path))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,7 +13,7 @@ from .exceptions import NoInstanceError, ImmutableTypeError, ReadonlyPropertyErr
 
 
 __Util_Funcs__     = ["mkdir","json_load","json_dump","read_csv","to_bytes","to_utf8","MD5","SHA1",]
-__Util_Class__     = ["ImmutableAttrsMixin",]
+__Util_Class__     = ["ImmutableAttrsMixin","FrozenSlotsMixin",]
 __Util_Decorator__ = ["singleton","noinstance","ReadonlyProperty",]
 __Util_MetaClass__ = ["Singleton","NoInstance",]
 
@@ -250,3 +250,44 @@ class ImmutableAttrsMixin(object):
         @link https://github.com/pallets/werkzeug/blob/master/werkzeug/datastructures.py  --> MultiDict
         """
         return self.__class__(**deepcopy(self.__dict__, memo=memo))
+
+
+class FrozenSlotsMixin(object):
+    """
+    基于 __slots__ 的不可变对象，ImmutableAttrsMixin 的替代
+    不修改类本身，可以在多个线程中同时创建：
+        - 子类声明 __slots__，在 __init__ 中通过 self._set 赋值
+        - 创建后不能通过 __setattr__/__delattr__ 修改，也没有 __dict__
+    关于复制：
+        - 调用 copy.copy     返回本身
+        - 调用 copy.deepcopy 返回新对象
+        - 可以 pickle（例如在进程间传递）
+    """
+    __slots__ = ()
+
+    def _set(self, key, value):
+        object.__setattr__(self, key, value)
+
+    def _fields(self):
+        return { key: getattr(self, key)
+                 for cls in reversed(self.__class__.__mro__)
+                 for key in cls.__dict__.get("__slots__", ()) }
+
+    def __setattr__(self, key, value):
+        _is_immutable(self)
+
+    def __delattr__(self, key):
+        _is_immutable(self)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo=None):
+        return self.__class__(**deepcopy(self._fields(), memo=memo))
+
+    def __getstate__(self):
+        return self._fields()
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            self._set(key, value)
@@ -0,0 +1,494 @@
+"""Parser for the course table of SupplyCancel.do
+
+get_courses only needs five cells from each row of the first `datagrid`
+table: the name, class ID, college, slots and the elect link. This parses
+just that table instead of building a BeautifulSoup tree of the whole page.
+There are three backends, and each returns the same Course records:
+
+- "lxml": libxml2 builds the tree and XPath picks out the rows. Needs lxml.
+- "stream": html.parser starts at the table and stops feeding the page at
+  its closing tag, so the rest of the page is never tokenized. Pure Python.
+- "soup": the original BeautifulSoup implementation, kept as the reference.
+
+The list is split into pages. page_count reads the pager so that the other
+pages can be fetched, and merge joins the pages into one list. Between slot
+changes the pages rarely change, so CourseTracker skips parsing a page whose
+fingerprint it has seen and reports only the rows whose slots changed.
+
+Benchmark them with `python course_table.py [captured.html ...]`. Without
+files it generates pages of several sizes laid out like SupplyCancel.do.
+"""
+
+import re
+import sys
+import hashlib
+import argparse
+from collections import namedtuple
+from html.parser import HTMLParser
+from time import perf_counter
+from urllib.parse import urljoin
+
+# Data structure for a course
+Course = namedtuple(
+    "Course", ["name", "classID", "college", "max_slots", "used_slots", "elect_address"]
+)
+
+# Columns of the datagrid rows that make up a Course
+NAME, CLASS_ID, COLLEGE, SLOTS, LINK = 0, 5, 6, 9, 10
+
+ROW_CLASS = re.compile("datagrid-(even|odd)")
+TABLE_START = re.compile(
+    r"""<table\b[^>]*\bclass\s*=\s*["']?[^"'>]*(?<![\w-])datagrid(?![\w-])""", re.IGNORECASE
+)
+
+# Pager of the course list: "第 1 页 / 共 3 页" and links with netui_row=electableListGrid;<offset>
+PAGE_TOTAL = re.compile(r"共\s*(\d+)\s*页")
+PAGE_OFFSET = re.compile(r"netui_row=electableListGrid(?:%3B|;)(\d+)", re.IGNORECASE)
+
+# Fragments that change between responses although the course list didn't:
+# session IDs rewritten into links and cache-busting numbers on images
+VOLATILE = [
+    re.compile(r";jsessionid=[\w.!-]+"),
+    re.compile(r"Rand=[\d.]+"),
+]
+
+# How much of the page html.parser is fed at a time by the stream backend
+CHUNK_SIZE = 8192
+
+
+def _course(cells, base_url):
+    """Build a Course from the text of each cell and the first link of the last one"""
+
+    if len(cells) <= LINK:
+        raise ValueError(f"Course row has {len(cells)} cells, expected at least {LINK + 1}")
+    texts, links = zip(*cells)
+    if links[LINK] is None:
+        raise ValueError(f"No elect link for {texts[NAME]}")
+    max_slots, used_slots = (int(s) for s in texts[SLOTS].split("/"))
+    return Course(
+        texts[NAME], texts[CLASS_ID], texts[COLLEGE], max_slots, used_slots, urljoin(base_url, links[LINK])
+    )
+
+
+def _has_class(value, name):
+    return name in (value or "").split()
+
+
+def parse_soup(html, base_url):
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, features="html.parser")
+    table = soup.find("table", class_="datagrid")
+    if table is None:
+        raise ValueError("No datagrid table")
+    courses = []
+    for item in table.find_all("tr", class_=ROW_CLASS):
+        cells = []
+        for data in item.find_all("td", class_="datagrid"):
+            link = data.find("a")
+            cells.append((data.text, link.get("href") if link is not None else None))
+        courses.append(_course(cells, base_url))
+    return courses
+
+
+# Class tests in XPath 1.0, matching whole class names like bs4's class_
+_DATAGRID = "contains(concat(' ', normalize-space(@class), ' '), ' datagrid ')"
+_ROWS = (
+    f"(//table[{_DATAGRID}])[1]//tr[contains(@class, 'datagrid-even') or contains(@class, 'datagrid-odd')]"
+)
+_CELLS = f".//td[{_DATAGRID}]"
+
+
+def parse_lxml(html, base_url):
+    import lxml.html
+
+    # lxml refuses a str that starts with an XML encoding declaration. Hand
+    # it UTF-8 bytes and say so, overriding any charset the page declares
+    parser = lxml.html.HTMLParser(encoding="utf-8")
+    courses = []
+    root = lxml.html.fromstring(html.encode("utf-8", "surrogatepass"), parser=parser)
+    if not root.xpath(f"//table[{_DATAGRID}]"):
+        raise ValueError("No datagrid table")
+    for row in root.xpath(_ROWS):
+        cells = []
+        for data in row.xpath(_CELLS):
+            links = data.xpath(".//a/@href")
+            cells.append((data.text_content(), links[0] if links else None))
+        courses.append(_course(cells, base_url))
+    return courses
+
+
+class _TableParser(HTMLParser):
+    """Collect the cells of datagrid rows, from the table's start tag to its end tag"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.rows = []
+        self.done = False
+        self._depth = 0  # nesting of <table> inside the datagrid table
+        self._row = None  # cells of the current datagrid row
+        self._text = None  # text of the current datagrid cell
+        self._link = None
+
+    def _end_cell(self):
+        if self._text is not None:
+            self._row.append(("".join(self._text), self._link))
+            self._text = self._link = None
+
+    def _end_row(self):
+        if self._row is not None:
+            self._end_cell()
+            self.rows.append(self._row)
+            self._row = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == "table":
+            self._depth += 1
+        elif tag == "tr":
+            self._end_row()
+            if ROW_CLASS.search(dict(attrs).get("class") or ""):
+                self._row = []
+        elif tag == "td" and self._row is not None:
+            self._end_cell()
+            if _has_class(dict(attrs).get("class"), "datagrid"):
+                self._text = []
+        elif tag == "a" and self._text is not None and self._link is None:
+            self._link = dict(attrs).get("href")
+
+    def handle_endtag(self, tag):
+        if self.done:
+            return
+        if tag == "td" and self._row is not None:
+            self._end_cell()
+        elif tag == "tr":
+            self._end_row()
+        elif tag == "table":
+            self._depth -= 1
+            if self._depth == 0:
+                self._end_row()
+                self.done = True
+
+    def handle_data(self, data):
+        if self._text is not None:
+            self._text.append(data)
+
+
+def parse_stream(html, base_url):
+    match = TABLE_START.search(html)
+    if match is None:
+        raise ValueError("No datagrid table")
+    parser = _TableParser()
+    for start in range(match.start(), len(html), CHUNK_SIZE):
+        parser.feed(html[start : start + CHUNK_SIZE])
+        if parser.done:
+            break
+    else:
+        parser.close()
+        parser._end_row()
+    return [_course(cells, base_url) for cells in parser.rows]
+
+
+def merge(pages):
+    """Concatenate the courses of several pages, dropping repeated courses
+
+    A course can show up on two pages when the list shifts between the
+    requests for them. The first copy is kept.
+    """
+
+    seen = set()
+    courses = []
+    for page in pages:
+        for course in page:
+            key = (course.name, course.classID, course.college)
+            if key not in seen:
+                seen.add(key)
+                courses.append(course)
+    return courses
+
+
+def page_count(html, page_size):
+    """Number of pages of the course list, read from the datagrid pager
+
+    Takes the larger of the "共 N 页" total and the page of the largest row
+    offset among its links. A page without a pager has one page.
+    """
+
+    pages = 1
+    for match in PAGE_TOTAL.finditer(html):
+        pages = max(pages, int(match.group(1)))
+    for match in PAGE_OFFSET.finditer(html):
+        pages = max(pages, int(match.group(1)) // page_size + 1)
+    return pages
+
+
+def fingerprint(html):
+    """Digest of the course table and everything after it, minus VOLATILE fragments
+
+    Pages with the same fingerprint parse to the same courses and page count.
+    """
+
+    match = TABLE_START.search(html)
+    if match is not None:
+        html = html[match.start() :]
+    for pattern in VOLATILE:
+        html = pattern.sub("", html)
+    return hashlib.blake2b(html.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+
+# A course whose slots changed, previous is None for a course not seen before
+CourseChange = namedtuple("CourseChange", ["course", "previous"])
+
+
+def diff(previous, current):
+    """Courses of `current` that are new or whose slots differ from `previous`"""
+
+    old = {(course.name, course.classID, course.college): course for course in previous}
+    changes = []
+    for course in current:
+        before = old.get((course.name, course.classID, course.college))
+        if before is None or (before.max_slots, before.used_slots) != (course.max_slots, course.used_slots):
+            changes.append(CourseChange(course, before))
+    return changes
+
+
+class CourseTracker:
+    """Parse only the pages of the course list that changed, and report changed rows
+
+    Each page is remembered by its fingerprint along with its courses, so an
+    unchanged page costs a hash instead of a parse. After update(), `changes`
+    holds the rows whose slots changed since the previous update. After
+    reset() every row counts as changed and `full` is set, so a course that
+    stayed electable is offered again, e.g. when electing it failed.
+    """
+
+    def __init__(self, parse):
+        self.parse = parse
+        self.courses = []
+        self.changes = []
+        self.full = True
+        self.parsed = 0
+        self.skipped = 0
+        self._pages = {}  # page number -> (fingerprint, courses)
+        self._dirty = True
+
+    def reset(self):
+        self.courses = []
+        self._dirty = True
+
+    def page(self, number, html):
+        """Courses of one page, parsed only if it changed since it was last seen"""
+
+        digest = fingerprint(html)
+        cached = self._pages.get(number)
+        if cached is not None and cached[0] == digest:
+            self.skipped += 1
+            return cached[1]
+        courses = self.parse(html)
+        self.parsed += 1
+        self._pages[number] = (digest, courses)
+        self._dirty = True
+        return courses
+
+    def update(self, pages):
+        """Merge the courses of pages 1..N returned by page() and find the changes"""
+
+        for number in [number for number in self._pages if number > len(pages)]:
+            del self._pages[number]
+            self._dirty = True
+        if not self._dirty:
+            self.changes = []
+            self.full = False
+            return self.courses
+        self.full = not self.courses
+        courses = merge(pages)
+        self.changes = diff(self.courses, courses)
+        self.courses = courses
+        self._dirty = False
+        return courses
+
+
+BACKENDS = {
+    "lxml": parse_lxml,
+    "stream": parse_stream,
+    "soup": parse_soup,
+}
+
+
+def default_backend():
+    """lxml when it is installed, the stream backend otherwise"""
+
+    try:
+        import lxml.html  # noqa: F401
+    except ImportError:
+        return "stream"
+    return "lxml"
+
+
+def parse(html, base_url, backend=None):
+    """Return the courses in the datagrid table of a SupplyCancel.do page
+
+    Raises ValueError when the page has no course table or a row is
+    malformed, as happens when the session has expired.
+    """
+
+    try:
+        parser = BACKENDS[backend or default_backend()]
+    except KeyError:
+        raise ValueError(f"Unknown course table backend {backend!r}, choose from {', '.join(BACKENDS)}")
+    return parser(html, base_url)
+
+
+# Benchmark
+
+_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta http-equiv="Content-Type" content="text/html; charset=UTF-8">
+<title>补退选</title>
+<link rel="stylesheet" href="/elective2008/resources/css/style.css">
+{scripts}
+</head>
+<body>
+<table class="tablegrid" width="100%"><tr><td>{notice}</td></tr></table>
+{tables}
+</body>
+</html>
+"""
+
+_TABLE = """<table class="datagrid" width="100%" cellspacing="1">
+<tr class="datagrid-header"><th class="datagrid">课程名</th><th class="datagrid">课程类别</th>\
+<th class="datagrid">学分</th><th class="datagrid">周学时</th><th class="datagrid">教师</th>\
+<th class="datagrid">班号</th><th class="datagrid">开课单位</th><th class="datagrid">年级</th>\
+<th class="datagrid">上课/考试信息</th><th class="datagrid">限数/已选</th><th class="datagrid">补选</th></tr>
+{rows}
+<tr><td class="datagrid-footer" colspan="11">第 1 页 / 共 1 页</td></tr>
+</table>"""
+
+_ROW = """<tr class="datagrid-{parity}">
+<td class="datagrid"><a href="/elective2008/edu/pku/stu/elective/controller/courseDetail/getCourseDetail.do?kclx=BK&amp;course_seq_no={seq}" target="_blank"><span>课程{i}</span></a></td>
+<td class="datagrid"><span>专业课</span></td>
+<td class="datagrid" align="center"><span>3.0</span></td>
+<td class="datagrid" align="center"><span>3.0</span></td>
+<td class="datagrid"><span>教师{i}(教授)</span></td>
+<td class="datagrid" align="center"><span>{cls}</span></td>
+<td class="datagrid"><span>学院{college}</span></td>
+<td class="datagrid"><span>全部</span></td>
+<td class="datagrid"><span>1~16周 每周周{day}第{unit}节 理教{room}<br>考试时间：2026年01月{day}日</span></td>
+<td class="datagrid" align="center"><span id="electedNum{i}">{max_slots} / {used}</span></td>
+<td class="datagrid" align="center"><a href="/elective2008/edu/pku/stu/elective/controller/supplement/electSupplement.do?index={i}&amp;xh=1&amp;seq={seq}" onclick="return confirmSelect(this)"><span>补选</span></a></td>
+</tr>"""
+
+
+def synthetic_page(n_rows, trailer=False, declaration=False):
+    """A page laid out like SupplyCancel.do, with `n_rows` courses
+
+    With `trailer`, another datagrid table of the same size follows the
+    course table, like the list of elected courses. Only the stream backend
+    never reads it. With `declaration`, the page starts with an XML
+    declaration, as XHTML pages do.
+    """
+
+    rows = "\n".join(
+        _ROW.format(
+            i=i,
+            seq=f"BZ2526{i:06d}",
+            parity="odd" if i % 2 else "even",
+            cls=i % 5 + 1,
+            college=i % 30,
+            day=i % 7 + 1,
+            unit=i % 12 + 1,
+            room=100 + i,
+            max_slots=120,
+            used=120 - i % 3,
+        )
+        for i in range(n_rows)
+    )
+    scripts = "\n".join(
+        f'<script type="text/javascript">function f{i}(a) {{ return a.replace(/&/g, "&amp;") + "<" + {i}; }}</script>'
+        for i in range(20)
+    )
+    tables = _TABLE.format(rows=rows) * (2 if trailer else 1)
+    page = _PAGE.format(scripts=scripts, notice="补退选说明" * 50, tables=tables)
+    return '<?xml version="1.0" encoding="UTF-8"?>\n' + page if declaration else page
+
+
+def _percentile(times, q):
+    times = sorted(times)
+    return times[min(len(times) - 1, int(q * len(times)))]
+
+
+def benchmark(pages, backends, repeat=50, base_url="https://elective.pku.edu.cn"):
+    """Time each backend on each (label, html) page against the soup backend
+
+    Every backend must return the same courses as soup on every page. Also
+    times CourseTracker on a page it has seen, under "unchanged".
+    Returns {label: {backend: (median, p99)}} in seconds.
+    """
+
+    results = {}
+    for label, html in pages:
+        reference = parse_soup(html, base_url)
+        results[label] = {}
+        for backend in backends:
+            parser = BACKENDS[backend]
+            if parser(html, base_url) != reference:
+                raise AssertionError(f"{backend} disagrees with soup on {label}")
+            times = []
+            for _ in range(repeat):
+                start = perf_counter()
+                parser(html, base_url)
+                times.append(perf_counter() - start)
+            results[label][backend] = (_percentile(times, 0.5), _percentile(times, 0.99))
+        # An unchanged page only costs its fingerprint
+        tracker = CourseTracker(lambda html: parse(html, base_url))
+        tracker.page(1, html)
+        times = []
+        for _ in range(repeat):
+            start = perf_counter()
+            tracker.page(1, html)
+            times.append(perf_counter() - start)
+        results[label]["unchanged"] = (_percentile(times, 0.5), _percentile(times, 0.99))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python course_table.py", description="Benchmark the course table parsers"
+    )
+    parser.add_argument("pages", nargs="*", help="captured SupplyCancel.do pages")
+    parser.add_argument("--rows", default="10,50,200", help="course counts of generated pages, without files")
+    parser.add_argument("--trailer", action="store_true", help="add a second datagrid table to generated pages")
+    parser.add_argument("-n", "--repeat", type=int, default=50)
+    parser.add_argument("--backend", action="append", choices=list(BACKENDS), help="default: all")
+    args = parser.parse_args(argv)
+
+    if args.pages:
+        pages = []
+        for path in args.pages:
+            with open(path, encoding="utf-8", errors="replace") as f:
+                pages.append((path, f.read()))
+    else:
+        rows = [int(s) for s in args.rows.split(",")]
+        pages = [(f"{n} rows", synthetic_page(n, args.trailer)) for n in rows]
+        # Every backend must also cope with an XML declaration, which lxml refuses in a str
+        pages.append((f"{rows[0]} rows, XML declaration", synthetic_page(rows[0], args.trailer, True)))
+    backends = args.backend or list(BACKENDS)
+    if "soup" not in backends:
+        backends.append("soup")
+
+    results = benchmark(pages, backends, args.repeat)
+    for label, html in pages:
+        baseline = results[label]["soup"][0]
+        print(f"{label}: {len(html) / 1024:.0f} KiB, {len(parse_soup(html, 'https://x/'))} courses")
+        for backend in [*backends, "unchanged"]:
+            median, p99 = results[label][backend]
+            print(
+                f"  {backend:<9} median {median * 1e3:7.3f} ms  p99 {p99 * 1e3:7.3f} ms"
+                f"  {baseline / median:5.1f}x soup"
+            )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
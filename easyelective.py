@@ -1,16 +1,22 @@
 import sys
+import argparse
 import yaml
 import csv
-import re
-from collections import namedtuple
-from time import sleep
-from urllib.parse import urljoin
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from time import sleep, monotonic
 
 import requests
 from bs4 import BeautifulSoup
 from loguru import logger
 
-from captcha import recognize_captcha
+import course_table
+from course_table import Course
+from transport import Transport, dns_cache
+from captcha import recognizer, ArtifactSink, CaptchaDataset, metrics
+from captcha.classifier import ClassifierMixin, Ensemble, get_classifier
+from captcha.exceptions import CaptchaRejectedException, ImageProcessorException
 
 
 class EasyElectiveException(Exception):
@@ -43,21 +49,54 @@ class IllegalOperationError(EasyElectiveException):
     pass
 
 
-# Data structure for a course
-Course = namedtuple(
-    "Course", ["name", "classID", "college", "max_slots", "used_slots", "elect_address"]
-)
-
 # Setup logger
 logger.remove()
 logger.add(sys.stderr, level="INFO")
 logger.add("info.log", level="INFO")
 logger.add("debug.log", level="DEBUG")
 
+# Endpoints, shared with the asyncio client in easyelective_async.py
+IAAA_LOGIN_URL = "https://iaaa.pku.edu.cn/iaaa/oauthlogin.do"
+ELECTIVE_BASE_URL = "http://elective.pku.edu.cn"
+ELECTIVE_LOGIN_URL = ELECTIVE_BASE_URL + "/elective2008/ssoLogin.do"
+ELECTIVE_REDIRECT_URL = "http://elective.pku.edu.cn/elective2008/agent4Iaaa.jsp/../ssoLogin.do"
+SUPPLY_CANCEL_URL = ELECTIVE_BASE_URL + "/elective2008/edu/pku/stu/elective/controller/supplement/SupplyCancel.do"
+DRAW_SERVLET_URL = ELECTIVE_BASE_URL + "/elective2008/DrawServlet"
+SUPPLEMENT_URL = ELECTIVE_BASE_URL + "/elective2008/edu/pku/stu/elective/controller/supplement/supplement.jsp"
+VALIDATE_URL = ELECTIVE_BASE_URL + "/elective2008/edu/pku/stu/elective/controller/supplement/validate.do"
+
+# Fake referer and user agent
+HEADERS = {
+    "Referer": "http://elective.pku.edu.cn/elective2008/edu/pku/stu/elective/controller/help/HelpController.jpf",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/69.0.3497.100 Safari/537.36",
+}
+
+# Every request goes through this transport, see transport.py. The pool has
+# room for the page fetches, the captcha prefetcher and keepalive at once
+transport = Transport(headers=HEADERS, pool_size=8)
+
+# Backend of course_table used by parse_courses, None picks lxml when installed
+course_parser = None
+
+# Courses per page of the course list, and pages seen on the last refresh
+COURSE_PAGE_SIZE = 50
+course_pages = 1
+# Fetches pages 2..N of the course list alongside page 1
+page_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="CoursePage")
+
+
+def course_page_params(page):
+    """Query of supplement.jsp for one page of the course list"""
+
+    return {
+        "netui_pagesize": f"electableListGrid;{COURSE_PAGE_SIZE}",
+        "netui_row": f"electableListGrid;{(page - 1) * COURSE_PAGE_SIZE}",
+    }
+
 
 def get_iaaa_token(appid, username, password, redir):
     logger.debug("Attempting to get iaaa token")
-    url = "https://iaaa.pku.edu.cn/iaaa/oauthlogin.do"
+    url = IAAA_LOGIN_URL
     form = dict(
         appid=appid,
         userName=username,
@@ -69,7 +108,7 @@ def get_iaaa_token(appid, username, password, redir):
     )
 
     try:
-        r = requests.post(url, data=form, timeout=5)
+        r = transport.post(url, endpoint="iaaa", data=form)
     except requests.exceptions.RequestException:
         raise NetworkError
 
@@ -83,25 +122,17 @@ def get_iaaa_token(appid, username, password, redir):
 
 def get_elective_session(username, password):
     logger.debug("Attempting to get elective session")
-    session = requests.Session()
-
-    # Fake referer and user agent
-    session.headers.update(
-        {
-            "Referer": "http://elective.pku.edu.cn/elective2008/edu/pku/stu/elective/controller/help/HelpController.jpf",
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/69.0.3497.100 Safari/537.36",
-        }
-    )
+    # Reuse the pooled connections, but not the cookies of an earlier login
+    session = transport.reset()
 
     # Pass username and password to IAAA, and get IAAA token
     appid = "syllabus"
-    redir = "http://elective.pku.edu.cn/elective2008/agent4Iaaa.jsp/../ssoLogin.do"
-    token = get_iaaa_token(appid, username, password, redir)
+    token = get_iaaa_token(appid, username, password, ELECTIVE_REDIRECT_URL)
 
     # Pass IAAA token to elective.pku.edu.cn, and get elective session
-    login_url = "http://elective.pku.edu.cn/elective2008/ssoLogin.do"
+    login_url = ELECTIVE_LOGIN_URL
     try:
-        resp = session.get(login_url, params={"token": token}, timeout=5)
+        resp = session.get(login_url, endpoint="login", params={"token": token})
         if resp.status_code != 200:
             raise AuthenticationError
         logger.debug("Successfully got elective session")
@@ -110,78 +141,230 @@ def get_elective_session(username, password):
         raise NetworkError from e
 
 
+def fetch_course_page(session, page):
+    """Return the HTML of one page of the course list"""
+
+    try:
+        if page == 1:
+            resp = session.get(SUPPLY_CANCEL_URL, endpoint="courses")
+        else:
+            resp = session.get(SUPPLEMENT_URL, endpoint="courses", params=course_page_params(page))
+    except requests.exceptions.RequestException as e:
+        logger.debug(f"Network error while trying to get page {page} of course list")
+        raise NetworkError from e
+    return resp.text
+
+
 def get_courses(session):
-    """Return an list of courses in selection plan
-    Only gets the first page of courses for simplicity.
+    """Return a list of courses in selection plan, from all of its pages
+
+    Pages 2..N are requested at the same time as page 1, N being the page
+    count seen on the previous refresh, so a refresh takes one round trip.
+    Pages the pager of page 1 adds are fetched together right after.
+    Unchanged pages are not parsed again, and course_tracker.changes lists
+    the courses whose slots changed.
     """
 
+    global course_pages
     logger.debug("Attempting to get courses")
-    url_supply_cancel = "http://elective.pku.edu.cn/elective2008/edu/pku/stu/elective/controller/supplement/SupplyCancel.do"
-    # page2 = "http://elective.pku.edu.cn/elective2008/edu/pku/stu/elective/controller/supplement/supplement.jsp?netui_pagesize=electableListGrid%3B50&netui_row=electableListGrid%3B50"
-
-    courses = []
-
+    known = course_pages
+    pending = {page: page_pool.submit(fetch_course_page, session, page) for page in range(2, known + 1)}
     try:
-        resp = session.get(url_supply_cancel, timeout=5)
-    except requests.exceptions.RequestException as e:
-        logger.debug("Network error while trying to get course list")
-        raise NetworkError from e
+        html = fetch_course_page(session, 1)
+        pages = course_table.page_count(html, COURSE_PAGE_SIZE)
+        for page in range(known + 1, pages + 1):
+            pending[page] = page_pool.submit(fetch_course_page, session, page)
+        courses = [course_tracker.page(1, html)]
+        courses.extend(course_tracker.page(page, pending[page].result()) for page in range(2, pages + 1))
+    finally:
+        for future in pending.values():
+            future.cancel()
+    if pages != known:
+        logger.debug(f"Course list has {pages} pages")
+        course_pages = pages
+    return course_tracker.update(courses)
+
+
+def parse_courses(html):
+    """Parse the course table of SupplyCancel.do"""
 
     try:
-        # Parse HTML
-        soup = BeautifulSoup(resp.text, features="html.parser")
-        table = soup.find("table", class_="datagrid")
-        items = table.find_all("tr", class_=re.compile("datagrid-(even|odd)"))
-        for item in items:
-            data = item.find_all("td", class_="datagrid")
-            # Parse course info
-            name = data[0].text
-            classID = data[5].text
-            college = data[6].text
-            max_slots, used_slots = (int(s) for s in data[9].text.split("/"))
-            base_url = "http://elective.pku.edu.cn"
-            elect_address = urljoin(base_url, data[10].find("a")["href"])
-            courses.append(
-                Course(name, classID, college, max_slots, used_slots, elect_address)
-            )
-        return courses
-    except (ValueError, AttributeError) as e:
+        return course_table.parse(html, ELECTIVE_BASE_URL, course_parser)
+    except ValueError as e:
         logger.info("Failed to parse course list", stack_info=True)
         raise SessionExpiredError from e
 
 
-def solve_captcha(session):
-    """Request captcha from elective and upload the correct answer"""
+# Pages of the course list by fingerprint, and the courses that changed on the last refresh
+course_tracker = course_table.CourseTracker(parse_courses)
+
+
+# Captcha statistics, used to compare round trips per accepted captcha
+captcha_stats = dict(fetches=0, rejects=0, validations=0, successes=0)
+
+
+def solve_captcha(session, stop=None):
+    """Request captchas from elective until the answer is accepted
+
+    Captchas recognized with low confidence are rejected locally and
+    replaced, without spending a validate.do round trip on them. Returns
+    True once a captcha is accepted, or False if the `stop` event is set
+    before that.
+    """
 
     logger.debug("Attempting to solve a captcha")
-    # Request a new captcha
-    request_captcha_url = "http://elective.pku.edu.cn/elective2008/DrawServlet"
-    img_bytes = session.get(request_captcha_url).content
 
-    # Recognize the captcha
-    result = recognize_captcha(img_bytes)
+    while True:
+        if stop is not None and stop.is_set():
+            return False
+        # Request a new captcha
+        try:
+            img_bytes = session.get(DRAW_SERVLET_URL, endpoint="captcha").content
+        except requests.exceptions.RequestException as e:
+            raise NetworkError from e
+        captcha_stats["fetches"] += 1
 
-    # Upload result to elective
-    submit_url = "http://elective.pku.edu.cn/elective2008/edu/pku/stu/elective/controller/supplement/validate.do"
-    resp = session.post(submit_url, data={"validCode": result}, timeout=5)
+        # Recognize the captcha in memory
+        try:
+            result = recognizer.recognize(img_bytes, capture=False)
+        except (CaptchaRejectedException, ImageProcessorException):
+            captcha_stats["rejects"] += 1
+            logger.debug("Captcha rejected locally, fetching a new one")
+            continue
 
-    # If failed, retry
-    try:
-        if resp.json()["valid"] != "2":
-            solve_captcha(session)
-    except ValueError:
-        raise SessionExpiredError
+        # Upload result to elective
+        try:
+            resp = session.post(VALIDATE_URL, endpoint="validate", data={"validCode": result.code})
+        except requests.exceptions.RequestException as e:
+            raise NetworkError from e
+        captcha_stats["validations"] += 1
+
+        # If failed, retry
+        try:
+            passed = resp.json()["valid"] == "2"
+        except ValueError:
+            raise SessionExpiredError
+        recognizer.report(result, passed)
+        if passed:
+            captcha_stats["successes"] += 1
+            round_trips = captcha_stats["validations"] / captcha_stats["successes"]
+            logger.debug(
+                f"Captcha accepted, {round_trips:.2f} validate round trips per success, stats: {captcha_stats}"
+            )
+            return True
+
+
+@contextmanager
+def captcha_solved(session):
+    """Solve a captcha synchronously before the election request"""
+
+    solve_captcha(session)
+    yield
+
+
+class CaptchaPrefetcher:
+    """Keep a validated captcha ready for a session
+
+    A background thread solves a captcha whenever the session has no fresh
+    one, so elect() can send the election request as soon as a slot opens.
+    A validated captcha is used for one election and is considered expired
+    after `validity` seconds. All captcha traffic of the session goes
+    through one lock, so a refresh never replaces a captcha in use.
+    """
+
+    def __init__(self, session, validity=60, margin=5):
+        self.session = session
+        self.validity = validity
+        self.margin = margin
+        self.hits = 0
+        self.misses = 0
+        self.saved = 0.0
+        self._validated_at = None
+        self._solve_time = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="CaptchaPrefetcher", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the thread and wait for it, so no captcha request of it is left in flight
+
+        The next prefetcher shares the transport and has its own lock. It
+        must not start while this one can still replace the captcha.
+        """
+
+        self._stop.set()
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _age(self):
+        if self._validated_at is None:
+            return None
+        return monotonic() - self._validated_at
+
+    def _refresh(self, stop=None):
+        start = monotonic()
+        if not solve_captcha(self.session, stop):
+            return False
+        self._validated_at = monotonic()
+        self._solve_time = self._validated_at - start
+        return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._lock:
+                age = self._age()
+                if age is None or age > self.validity - self.margin:
+                    try:
+                        if self._refresh(self._stop):
+                            logger.debug(f"Prefetched a captcha in {self._solve_time:.2f}s")
+                    except (NetworkError, SessionExpiredError, requests.exceptions.RequestException):
+                        self._validated_at = None
+                        logger.debug("Failed to prefetch a captcha")
+            self._stop.wait(1)
+
+    @contextmanager
+    def validated(self):
+        """Hold a validated captcha while electing, solving one if none is fresh"""
+
+        with self._lock:
+            age = self._age()
+            if age is not None and age < self.validity:
+                self.hits += 1
+                self.saved += self._solve_time
+                logger.info(
+                    f"Using prefetched captcha, saved {self._solve_time:.2f}s "
+                    f"({self.saved:.2f}s over {self.hits} elections, {self.misses} misses)"
+                )
+            else:
+                self.misses += 1
+                self._refresh()
+            self._validated_at = None
+            yield
 
 
-def elect(session, course):
+def elect(session, course, prefetcher=None):
     """Attempt to elect a course"""
 
     logger.info(f"Attempting to elect {course.name}")
-    # Solve a captcha
-    solve_captcha(session)
+    # Solve a captcha, or use the one prefetched for this session
+    with prefetcher.validated() if prefetcher else captcha_solved(session):
+        # Never retried, the request itself elects the course
+        try:
+            resp = session.get(course.elect_address, endpoint="elect", idempotent=False)
+        except requests.exceptions.RequestException as e:
+            raise NetworkError from e
+    check_elect_result(resp.text, course)
+
+
+def check_elect_result(html, course):
+    """Parse the reply of an election request, raise if it failed"""
+
     try:
-        resp = session.get(course.elect_address)
-        soup = BeautifulSoup(resp.text, features="html.parser")
+        soup = BeautifulSoup(html, features="html.parser")
         msg = soup.find(id="msgTips").text
     except (KeyError, AttributeError) as e:
         raise SessionExpiredError from e
@@ -194,28 +377,112 @@ def elect(session, course):
         raise IllegalOperationError
 
 
+def load_config(path="config.yaml"):
+    """Read config.yaml and set up the captcha recognizer accordingly"""
+
+    with open(path) as config_file:
+        config = yaml.load(config_file, Loader=yaml.BaseLoader)
+        artifacts = config.get("captchaArtifacts")
+        shared_model = config.get("sharedModel", "false").lower() == "true"
+        classifier = config.get("captchaClassifier", "auto")
+        use_ensemble = config.get("captchaEnsemble", "false").lower() == "true"
+        reject_threshold = float(config.get("captchaRejectThreshold", "0"))
+        metrics_interval = float(config.get("captchaMetricsInterval", "0"))
+        record_dataset = config.get("captchaDataset", "false").lower() == "true"
+        parser = config.get("courseParser", "auto")
+    # Parse the course list with lxml when it is installed, unless a backend is named
+    global course_parser
+    course_parser = None if parser == "auto" else parser
+    if course_parser not in (None, *course_table.BACKENDS):
+        raise ValueError(f"Unknown courseParser {parser}, choose from auto, {', '.join(course_table.BACKENDS)}")
+    # Share the decompressed model pages between processes on the same host
+    if shared_model:
+        ClassifierMixin.Mmap_Mode = "r"
+    # The classifier comes from captcha/model/policy.json unless one is named
+    if classifier != "auto":
+        recognizer.set_classifier(get_classifier(classifier))
+    # Optionally let KNN, SVM and RandomForest vote, and reject unsure answers
+    if use_ensemble:
+        ensemble = Ensemble().warmup()
+        for alg, error in ensemble.failed.items():
+            logger.warning(f"Captcha ensemble: {alg} model could not be loaded and is left out ({error})")
+        recognizer.set_classifier(ensemble)
+    recognizer.Reject_Threshold = reject_threshold
+    # Record per-stage captcha timings and log a summary periodically
+    if metrics_interval > 0:
+        metrics.enabled = True
+    # Load the captcha model before polling starts
+    recognizer.warmup()
+    # Optionally keep misread captchas for diagnosis, written in background
+    if artifacts:
+        recognizer.sink = ArtifactSink(
+            sample_rate=float(artifacts.get("sampleRate", "1")),
+            only_failures=artifacts.get("onlyFailures", "true").lower() == "true",
+            max_files=int(artifacts.get("maxFiles", "2000")),
+        )
+    # Record the segments of captchas accepted by elective for retraining
+    if record_dataset:
+        recognizer.dataset = CaptchaDataset()
+    return config
+
+
+def load_targets(path="targets.csv"):
+    with open(path, newline="") as courses_file:
+        csv_reader = csv.DictReader(courses_file)
+        return list(csv_reader)
+
+
+def search_courses(courses, target):
+    """Courses that correspond to target name, classID and college"""
+
+    # Convert classID to int before comparision
+    return [
+        course
+        for course in courses
+        if course.name == target["courseName"]
+        if int(course.classID) == int(target["classID"])
+        if course.college == target["college"]
+    ]
+
+
 @logger.catch
 def main():
     logger.info("Easy elective, version 0.1")
+    # Cache DNS answers for the requests transport, which patches socket.getaddrinfo
+    dns_cache.install()
     # Load config
-    with open("config.yaml") as config_file:
-        config = yaml.load(config_file, Loader=yaml.BaseLoader)
-        username = config["studentID"]
-        password = config["password"]
+    config = load_config()
+    username = config["studentID"]
+    password = config["password"]
+    metrics_interval = float(config.get("captchaMetricsInterval", "0"))
+    captcha_validity = float(config.get("captchaValidity", "0"))
+    keepalive_interval = float(config.get("keepAliveInterval", "30"))
+    last_metrics_log = monotonic()
     # Load target courses
-    with open("targets.csv", newline="") as courses_file:
-        csv_reader = csv.DictReader(courses_file)
-        targets = list(csv_reader)
+    targets = load_targets()
 
     session_expired = True
+    prefetcher = None
 
     while targets:
+        # Wait for the old session's prefetcher before logging in on the shared transport
+        if session_expired and prefetcher is not None:
+            prefetcher.stop()
+            prefetcher = None
         while session_expired:
             # Login into elective
             try:
                 sess = get_elective_session(username, password)
                 logger.info("Got elective session")
                 session_expired = False
+                # Offer every course again on the new session
+                course_tracker.reset()
+                # Keep a validated captcha ready for the new session
+                if captcha_validity > 0:
+                    prefetcher = CaptchaPrefetcher(sess, captcha_validity).start()
+                # Keep connections to elective open so electing never waits on a handshake
+                if keepalive_interval > 0:
+                    transport.start_keepalive(ELECTIVE_BASE_URL + "/", keepalive_interval)
             except AuthenticationError:
                 logger.critical(
                     "Authentication error. Please check your student ID and password"
@@ -228,20 +495,16 @@ def main():
 
         logger.debug("Refreshing course list")
         try:
-            courses = get_courses(sess)
-            for target in targets:
+            get_courses(sess)
+            # Only courses whose slots changed can have become electable
+            changed = [change.course for change in course_tracker.changes]
+            # Iterate over a copy, elected and missing targets are removed on the way
+            for target in list(targets):
                 # Search courses that correspond to target name and classID
-                # Convert classID to int before comparision
-                search_result = [
-                    course
-                    for course in courses
-                    if course.name == target["courseName"]
-                    if int(course.classID) == int(target["classID"])
-                    if course.college == target["college"]
-                ]
-
-                # Warn if no course correspond to target
-                if not search_result:
+                search_result = search_courses(changed, target)
+
+                # Warn if no course correspond to target, which only a full refresh can tell
+                if not search_result and course_tracker.full:
                     logger.warning(
                         f"Target {target['courseName']} not found in election plan."
                     )
@@ -253,7 +516,7 @@ def main():
                         logger.info(
                             f"Discovered a electable course: {course.name}, class {course.classID}, {course.max_slots}/{course.used_slots}"
                         )
-                        elect(sess, course)
+                        elect(sess, course, prefetcher)
                         targets.remove(target)
         except SessionExpiredError:
             logger.warning(
@@ -265,12 +528,35 @@ def main():
                 f"Illegal Operation detected. Ignoring target {target['courseName']}"
             )
             targets.remove(target)
+            # Offer the courses the interrupted scan skipped again
+            course_tracker.reset()
         except NetworkError:
             # Retry
             logger.warning("Network error detected, retrying...")
+            course_tracker.reset()
+        if metrics.enabled and monotonic() - last_metrics_log >= metrics_interval:
+            logger.info(f"Captcha timings: {metrics.format_summary() or 'no captcha solved yet'}")
+            last_metrics_log = monotonic()
         sleep(10)
     logger.info("No more targets available. Exiting...")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Easy elective")
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="use the asyncio client, which needs aiohttp",
+    )
+    args = parser.parse_args()
+    if args.use_async:
+        import asyncio
+
+        # Let easyelective_async share this module instead of importing a second copy
+        sys.modules.setdefault("easyelective", sys.modules["__main__"])
+        import easyelective_async
+
+        asyncio.run(easyelective_async.main())
+    else:
+        main()
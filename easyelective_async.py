@@ -0,0 +1,398 @@
+"""asyncio client for EasyElective
+
+The same flow as easyelective.py, run on one event loop. Course-list
+refreshes, captcha prefetching and elections overlap instead of running one
+after another. Captcha recognition runs in a worker thread so it never
+blocks the loop. Needs aiohttp. Start it with `python easyelective.py --async`.
+"""
+
+import sys
+import asyncio
+from contextlib import asynccontextmanager
+from time import monotonic
+
+import aiohttp
+from loguru import logger
+
+import course_table
+import easyelective as ee
+from transport import AsyncTransport
+from easyelective import (
+    AuthenticationError,
+    NetworkError,
+    SessionExpiredError,
+    IllegalOperationError,
+    captcha_stats,
+)
+from captcha import recognizer, metrics
+from captcha.exceptions import CaptchaRejectedException, ImageProcessorException
+
+POLL_INTERVAL = 10
+
+# Pages of the course list seen on the last refresh
+course_pages = 1
+# Pages of the course list by fingerprint, and the courses that changed on the last refresh
+course_tracker = course_table.CourseTracker(ee.parse_courses)
+
+# Errors raised by aiohttp for connection failures and timeouts
+HTTP_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+async def get_iaaa_token(http, appid, username, password, redir):
+    logger.debug("Attempting to get iaaa token")
+    form = dict(
+        appid=appid,
+        userName=username,
+        password=password,
+        randCode="",
+        smsCode="",
+        otpCode="",
+        redirUrl=redir,
+    )
+
+    try:
+        _, data = await http.fetch("POST", ee.IAAA_LOGIN_URL, endpoint="iaaa", read="json", data=form)
+    except HTTP_ERRORS as e:
+        raise NetworkError from e
+
+    try:
+        token = data["token"]
+    except (KeyError, TypeError):
+        raise AuthenticationError("Failed to get IAAA token")
+    logger.debug("Successfully got IAAA token")
+    return token
+
+
+async def get_elective_session(username, password):
+    logger.debug("Attempting to get elective session")
+    session = AsyncTransport(headers=ee.HEADERS, pool_size=8)
+    try:
+        # Pass username and password to IAAA, and get IAAA token
+        appid = "syllabus"
+        token = await get_iaaa_token(session, appid, username, password, ee.ELECTIVE_REDIRECT_URL)
+
+        # Pass IAAA token to elective.pku.edu.cn, and get elective session
+        try:
+            status, _ = await session.fetch(
+                "GET", ee.ELECTIVE_LOGIN_URL, endpoint="login", read="bytes", params={"token": token}
+            )
+            if status != 200:
+                raise AuthenticationError
+        except HTTP_ERRORS as e:
+            raise NetworkError from e
+    except BaseException:
+        await session.close()
+        raise
+    logger.debug("Successfully got elective session")
+    return session
+
+
+async def fetch_course_page(session, page):
+    """Return the HTML of one page of the course list"""
+
+    try:
+        if page == 1:
+            _, html = await session.fetch("GET", ee.SUPPLY_CANCEL_URL, endpoint="courses")
+        else:
+            _, html = await session.fetch(
+                "GET", ee.SUPPLEMENT_URL, endpoint="courses", params=ee.course_page_params(page)
+            )
+    except HTTP_ERRORS as e:
+        logger.debug(f"Network error while trying to get page {page} of course list")
+        raise NetworkError from e
+    return html
+
+
+async def get_courses(session):
+    """Return a list of courses in selection plan, from all of its pages
+
+    Fetches pages the same way as easyelective.get_courses: pages seen on
+    the previous refresh go out together with page 1. Unchanged pages are
+    not parsed again, and course_tracker.changes lists the changed courses.
+    """
+
+    global course_pages
+    logger.debug("Attempting to get courses")
+    known = course_pages
+    pending = {page: asyncio.create_task(fetch_course_page(session, page)) for page in range(2, known + 1)}
+    try:
+        html = await fetch_course_page(session, 1)
+        pages = course_table.page_count(html, ee.COURSE_PAGE_SIZE)
+        for page in range(known + 1, pages + 1):
+            pending[page] = asyncio.create_task(fetch_course_page(session, page))
+        courses = [course_tracker.page(1, html)]
+        for page in range(2, pages + 1):
+            courses.append(course_tracker.page(page, await pending[page]))
+    finally:
+        for task in pending.values():
+            task.cancel()
+        # Retrieve what the other pages raised, so it isn't logged as never retrieved
+        await asyncio.gather(*pending.values(), return_exceptions=True)
+    if pages != known:
+        logger.debug(f"Course list has {pages} pages")
+        course_pages = pages
+    return course_tracker.update(courses)
+
+
+async def solve_captcha(session):
+    """Request captchas from elective until the answer is accepted"""
+
+    logger.debug("Attempting to solve a captcha")
+
+    while True:
+        # Request a new captcha
+        try:
+            _, img_bytes = await session.fetch("GET", ee.DRAW_SERVLET_URL, endpoint="captcha", read="bytes")
+        except HTTP_ERRORS as e:
+            raise NetworkError from e
+        captcha_stats["fetches"] += 1
+
+        # Recognize the captcha in a worker thread
+        try:
+            result = await asyncio.to_thread(recognizer.recognize, img_bytes, capture=False)
+        except (CaptchaRejectedException, ImageProcessorException):
+            captcha_stats["rejects"] += 1
+            logger.debug("Captcha rejected locally, fetching a new one")
+            continue
+
+        # Upload result to elective
+        try:
+            _, data = await session.fetch(
+                "POST", ee.VALIDATE_URL, endpoint="validate", read="json", data={"validCode": result.code}
+            )
+        except HTTP_ERRORS as e:
+            raise NetworkError from e
+        except ValueError:
+            raise SessionExpiredError
+        captcha_stats["validations"] += 1
+
+        # If failed, retry
+        try:
+            passed = data["valid"] == "2"
+        except (KeyError, TypeError):
+            raise SessionExpiredError
+        recognizer.report(result, passed)
+        if passed:
+            captcha_stats["successes"] += 1
+            logger.debug(f"Captcha accepted, stats: {captcha_stats}")
+            return
+
+
+@asynccontextmanager
+async def captcha_solved(session):
+    """Solve a captcha before the election request"""
+
+    await solve_captcha(session)
+    yield
+
+
+class CaptchaPrefetcher:
+    """Keep a validated captcha ready for a session
+
+    The asyncio counterpart of easyelective.CaptchaPrefetcher: a task solves
+    a captcha whenever the session has no fresh one, and all captcha traffic
+    of the session goes through one lock.
+    """
+
+    def __init__(self, session, validity=60, margin=5):
+        self.session = session
+        self.validity = validity
+        self.margin = margin
+        self.hits = 0
+        self.misses = 0
+        self.saved = 0.0
+        self._validated_at = None
+        self._solve_time = 0.0
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def _age(self):
+        if self._validated_at is None:
+            return None
+        return monotonic() - self._validated_at
+
+    async def _refresh(self):
+        start = monotonic()
+        await solve_captcha(self.session)
+        self._validated_at = monotonic()
+        self._solve_time = self._validated_at - start
+
+    async def _run(self):
+        while True:
+            async with self._lock:
+                age = self._age()
+                if age is None or age > self.validity - self.margin:
+                    try:
+                        await self._refresh()
+                        logger.debug(f"Prefetched a captcha in {self._solve_time:.2f}s")
+                    except (NetworkError, SessionExpiredError):
+                        self._validated_at = None
+                        logger.debug("Failed to prefetch a captcha")
+            await asyncio.sleep(1)
+
+    @asynccontextmanager
+    async def validated(self):
+        """Hold a validated captcha while electing, solving one if none is fresh"""
+
+        async with self._lock:
+            age = self._age()
+            if age is not None and age < self.validity:
+                self.hits += 1
+                self.saved += self._solve_time
+                logger.info(
+                    f"Using prefetched captcha, saved {self._solve_time:.2f}s "
+                    f"({self.saved:.2f}s over {self.hits} elections, {self.misses} misses)"
+                )
+            else:
+                self.misses += 1
+                await self._refresh()
+            self._validated_at = None
+            yield
+
+
+async def elect(session, course, prefetcher=None):
+    """Attempt to elect a course"""
+
+    logger.info(f"Attempting to elect {course.name}")
+    # Solve a captcha, or use the one prefetched for this session
+    async with prefetcher.validated() if prefetcher else captcha_solved(session):
+        # Never retried, the request itself elects the course
+        try:
+            _, html = await session.fetch("GET", course.elect_address, endpoint="elect", idempotent=False)
+        except HTTP_ERRORS as e:
+            raise NetworkError from e
+    ee.check_elect_result(html, course)
+
+
+async def login(username, password):
+    """Log into elective, retrying on network errors"""
+
+    while True:
+        try:
+            session = await get_elective_session(username, password)
+            logger.info("Got elective session")
+            return session
+        except AuthenticationError:
+            logger.critical("Authentication error. Please check your student ID and password")
+            sys.exit(1)
+        except NetworkError:
+            logger.info("Failed to get elective session. Retrying...")
+            await asyncio.sleep(POLL_INTERVAL)
+
+
+@logger.catch
+async def main(config_path="config.yaml", targets_path="targets.csv"):
+    logger.info("Easy elective, version 0.1 (asyncio)")
+    config = ee.load_config(config_path)
+    username = config["studentID"]
+    password = config["password"]
+    metrics_interval = float(config.get("captchaMetricsInterval", "0"))
+    captcha_validity = float(config.get("captchaValidity", "0"))
+    keepalive_interval = float(config.get("keepAliveInterval", "30"))
+    last_metrics_log = monotonic()
+    targets = ee.load_targets(targets_path)
+
+    session = None
+    prefetcher = None
+    # Elections in flight, keyed by task, valued by target
+    pending = {}
+
+    try:
+        while targets or pending:
+            if session is None:
+                session = await login(username, password)
+                # Offer every course again on the new session
+                course_tracker.reset()
+                # Keep a validated captcha ready for the new session
+                if captcha_validity > 0:
+                    prefetcher = CaptchaPrefetcher(session, captcha_validity).start()
+                # Keep connections to elective open so electing never waits on a handshake
+                if keepalive_interval > 0:
+                    session.start_keepalive(ee.ELECTIVE_BASE_URL + "/", keepalive_interval)
+
+            # Refresh the course list while earlier elections are still running
+            logger.debug("Refreshing course list")
+            session_expired = False
+            courses = None
+            try:
+                courses = await get_courses(session)
+            except NetworkError:
+                logger.warning("Network error detected, retrying...")
+            except SessionExpiredError:
+                logger.warning("Session has expired. Retrying...")
+                session_expired = True
+
+            busy = list(pending.values())
+            # Only courses whose slots changed can have become electable
+            changed = [change.course for change in course_tracker.changes]
+            for target in list(targets) if courses is not None else ():
+                if target in busy:
+                    continue
+                search_result = ee.search_courses(changed, target)
+                # Warn if no course correspond to target, which only a full refresh can tell
+                if not search_result:
+                    if course_tracker.full:
+                        logger.warning(f"Target {target['courseName']} not found in election plan.")
+                        targets.remove(target)
+                    continue
+                for course in search_result:
+                    if course.used_slots < course.max_slots:
+                        logger.info(
+                            f"Discovered a electable course: {course.name}, class {course.classID}, {course.max_slots}/{course.used_slots}"
+                        )
+                        pending[asyncio.create_task(elect(session, course, prefetcher))] = target
+                        break
+
+            if metrics.enabled and monotonic() - last_metrics_log >= metrics_interval:
+                logger.info(f"Captcha timings: {metrics.format_summary() or 'no captcha solved yet'}")
+                last_metrics_log = monotonic()
+
+            # Wait for the next poll, waking up early when an election finishes
+            if pending:
+                done, _ = await asyncio.wait(pending, timeout=POLL_INTERVAL)
+            else:
+                done = ()
+                if targets and not session_expired:
+                    await asyncio.sleep(POLL_INTERVAL)
+            for task in done:
+                target = pending.pop(task)
+                try:
+                    task.result()
+                    targets.remove(target)
+                except IllegalOperationError:
+                    logger.warning(f"Illegal Operation detected. Ignoring target {target['courseName']}")
+                    targets.remove(target)
+                except SessionExpiredError:
+                    logger.warning("Session has expired. Retrying...")
+                    session_expired = True
+                except NetworkError:
+                    logger.warning("Network error detected, retrying...")
+                    # The course may still be electable without its slots changing
+                    course_tracker.reset()
+
+            if session_expired:
+                # Elections still running on the old session are retried later
+                for task in pending:
+                    task.cancel()
+                pending.clear()
+                if prefetcher is not None:
+                    prefetcher.stop()
+                    prefetcher = None
+                await session.close()
+                session = None
+    finally:
+        for task in pending:
+            task.cancel()
+        if prefetcher is not None:
+            prefetcher.stop()
+        if session is not None:
+            await session.close()
+    logger.info("No more targets available. Exiting...")
@@ -0,0 +1,212 @@
+"""Check that the NumPy captcha preprocessing matches the original PIL code
+
+The original pixel-by-pixel implementations stay in captcha.preprocess as
+the "pil" engine. This script runs both engines on the same inputs and
+counts every case where they disagree:
+
+- denoise: ImageProcessor._denoise_pil against _denoise_array, for
+  denoise8 and denoise24 with repeat 1 and 2
+- crop: _search_blocks against _label_blocks (block spans and sizes, or
+  the same exception), and the full crop with engine="pil" against
+  engine="numpy" (spans and every segment), on denoised images
+- features: FeatureExtractor.feature3/4/5 at levels 1 to 3 against
+  copies of the original per-window loops below, on the segments those
+  images crop into and on random 22x22 segments
+
+The inputs are captcha-like images (four random bold characters in PIL's
+default font with salt-and-pepper noise) plus pure noise at densities
+from 5% to 50%, which exercises the scan-order corner cases of denoise.
+
+    python tools/check_equivalence.py [-n 200] [--seed 0]
+
+Exits non-zero on any mismatch.
+"""
+
+import os
+import sys
+import argparse
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, os.path.abspath(ROOT))
+
+from captcha.preprocess import ImageProcessor
+from captcha.feature import FeatureExtractor
+from captcha.exceptions import ImageProcessorException
+
+ALPHABET = "2356789ABCDEFGHJKLMNPRSTUVWXYZabcdefghijkmnpqrstuvwxyz"
+
+try:
+    FONT = ImageFont.load_default(size=14)  # Pillow >= 10.1
+except TypeError:
+    FONT = ImageFont.load_default()
+
+
+def captcha_like(rs, width=52, height=22):
+    """Four characters at jittered positions with noise, as a bool array (True is white)"""
+    img = Image.new("L", (width, height), 255)
+    draw = ImageDraw.Draw(img)
+    for k in range(4):
+        ch = ALPHABET[rs.randint(len(ALPHABET))]
+        xy = (3 + 12 * k + rs.randint(-2, 3), rs.randint(-2, 3))
+        draw.text(xy, ch, fill=0, font=FONT, stroke_width=1, stroke_fill=0)
+    ary = np.array(img) >= 128
+    noise = rs.rand(height, width) < rs.uniform(0.0, 0.08)
+    return ary ^ noise
+
+
+def noise(rs, width=52, height=22):
+    return rs.rand(height, width) >= rs.uniform(0.05, 0.5)
+
+
+def samples(n, seed=0):
+    """n captcha-like images followed by n noise images"""
+    rs = np.random.RandomState(seed)
+    return [captcha_like(rs) for _ in range(n)] + [noise(rs) for _ in range(n)]
+
+
+def check_denoise(imgs):
+    cases = mismatches = 0
+    for ary in imgs:
+        for steps, threshold in ((ImageProcessor.Steps8, 6), (ImageProcessor.Steps24, 20)):
+            for repeat in (1, 2):
+                expected = ImageProcessor._denoise_pil(Image.fromarray(ary), steps, threshold, repeat)
+                got = ImageProcessor._denoise_array(ary, steps, threshold, repeat)
+                cases += 1
+                mismatches += not np.array_equal(np.array(expected), got)
+    return cases, mismatches
+
+
+def _denoised(ary):
+    img = Image.fromarray(ary)
+    return ImageProcessor.denoise24(ImageProcessor.denoise8(img, repeat=1), repeat=1)
+
+
+def _outcome(func, *args):
+    try:
+        return func(*args)
+    except ImageProcessorException as e:
+        return e.__class__
+
+
+def _same_crop(expected, got):
+    if isinstance(expected, type) or isinstance(got, type):
+        return expected is got
+    (segs1, spans1), (segs2, spans2) = expected, got
+    return list(map(tuple, spans1)) == list(map(tuple, spans2)) and \
+        all(np.array_equal(np.array(a), np.array(b)) for a, b in zip(segs1, segs2))
+
+
+def check_crop(imgs):
+    cases = mismatches = 0
+    for ary in imgs:
+        img = _denoised(ary)
+        ary = np.array(img)
+
+        expected = _outcome(ImageProcessor._search_blocks, img)
+        got = _outcome(ImageProcessor._label_blocks, ary)
+        if not isinstance(expected, type):
+            expected = [ (left, right, len(block)) for block, left, right in expected ]
+        cases += 1
+        mismatches += expected != got
+
+        expected = _outcome(ImageProcessor.crop, img, "pil")
+        got = _outcome(ImageProcessor.crop, img, "numpy")
+        cases += 1
+        mismatches += not _same_crop(expected, got)
+    return cases, mismatches
+
+
+# The feature extraction loops as they were before the summed-area rewrite
+
+def feature3_loop(img, level):
+    ary = 1 - np.array(img.convert("1")).astype(int)
+    l = level
+    vector = []
+    for i in range(l, ary.shape[0]-l):
+        for j in range(l, ary.shape[1]-l):
+            vector.append(np.sum(ary[i-l:i+l+1, j-l:j+l+1]))
+    return np.array(vector)
+
+
+def feature4_loop(img, level):
+    ary = feature3_loop(img, level)
+    s = int(np.sqrt(ary.size))
+    ary = ary.reshape((s,s))
+    return np.concatenate([ary.sum(axis=0), ary.sum(axis=1)])
+
+
+def feature5_loop(img, level):
+    ary = 1 - np.array(img.convert("1")).astype(int)
+    l = level
+    s = 2 * l + 1
+    weight = np.zeros((s,s), dtype=int)
+    for k in range(l+1):
+        mask = np.array([k<=i<s-k and k<=j<s-k for i in range(s) for j in range(s)]).reshape((s,s))
+        weight[mask] += (k + 1)**2
+    vector = []
+    for i in range(l, ary.shape[0]-l):
+        for j in range(l, ary.shape[1]-l):
+            vector.append(np.sum(ary[i-l:i+l+1, j-l:j+l+1]*weight))
+    return np.array(vector)
+
+
+def segments(imgs, seed=0):
+    rs = np.random.RandomState(seed)
+    segs = [ rs.rand(22, 22) >= rs.uniform(0.05, 0.5) for _ in range(len(imgs) // 4) ]
+    for ary in imgs:
+        result = _outcome(ImageProcessor.crop, _denoised(ary))
+        if not isinstance(result, type):
+            segs.extend(np.array(seg) for seg in result[0])
+    return segs
+
+
+def check_features(imgs):
+    cases = mismatches = 0
+    pairs = (
+        (FeatureExtractor.feature3, feature3_loop),
+        (FeatureExtractor.feature4, feature4_loop),
+        (FeatureExtractor.feature5, feature5_loop),
+    )
+    for seg in segments(imgs):
+        img = Image.fromarray(seg)
+        for fast, loop in pairs:
+            for level in (1, 2, 3):
+                expected = loop(img, level)
+                got = fast(img, level)
+                cases += 1
+                mismatches += not np.array_equal(expected, got.astype(int))
+    return cases, mismatches
+
+
+CHECKS = {
+    "denoise": check_denoise,
+    "crop": check_crop,
+    "features": check_features,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the NumPy and PIL captcha implementations")
+    parser.add_argument("-n", type=int, default=200, help="images of each kind")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("checks", nargs="*", help="checks to run: " + ", ".join(CHECKS) + " (default all)")
+    args = parser.parse_args()
+    for name in args.checks:
+        if name not in CHECKS:
+            parser.error(f"unknown check {name!r}")
+
+    imgs = samples(args.n, args.seed)
+    failed = False
+    for name in args.checks or CHECKS:
+        cases, mismatches = CHECKS[name](imgs)
+        print(f"{name:10s} {mismatches} mismatches in {cases} cases")
+        failed |= mismatches > 0
+    print("FAILED" if failed else "OK")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
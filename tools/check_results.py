@@ -0,0 +1,172 @@
+"""Check that captcha recognition results are immutable and safe to share
+
+CaptchaRecognitionResult is built on util.FrozenSlotsMixin. This script
+fails if any of the following does not hold:
+
+- immutability: setting, deleting or adding an attribute raises
+  ImmutableTypeError, there is no __dict__, the sequence fields are
+  tuples, copy returns the same object, and deepcopy and pickle give an
+  equal copy;
+- shared reads: reader threads keep comparing every field of one shared
+  result with a snapshot taken before they started, while writer threads
+  build thousands of new results with distinct values and check each one
+  holds exactly what it was built from;
+- recognition: several threads recognizing the same captchas at once get
+  the same codes and confidences as a single thread.
+
+The thread switch interval is cut to a microsecond so threads interleave
+as often as possible.
+
+    python tools/check_results.py [--threads 8] [--rounds 2000]
+
+Exits non-zero on any failure.
+"""
+
+import os
+import sys
+import copy
+import pickle
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, os.path.abspath(ROOT))
+
+from captcha import recognizer, CaptchaRecognitionResult
+from captcha.synthetic import CaptchaGenerator
+from captcha.exceptions import ImmutableTypeError, ImageProcessorException
+
+FIELDS = CaptchaRecognitionResult.__slots__
+
+
+def snapshot(result):
+    return {key: getattr(result, key) for key in FIELDS}
+
+
+def check_immutable(result):
+    """Return a list of failures"""
+    failures = []
+    before = snapshot(result)
+    for key in FIELDS + ("extra",):
+        for action, attempt in (("setting", lambda: setattr(result, key, None)),
+                                ("deleting", lambda: delattr(result, key))):
+            try:
+                attempt()
+                failures.append(f"{action} {key} did not raise")
+            except ImmutableTypeError:
+                pass
+            except Exception as e:
+                failures.append(f"{action} {key} raised {e.__class__.__name__} instead of ImmutableTypeError")
+    if hasattr(result, "__dict__"):
+        failures.append("result has a __dict__")
+    for key in ("segs", "spans", "cache", "confidence"):
+        if not isinstance(getattr(result, key), tuple):
+            failures.append(f"{key} is a {type(getattr(result, key)).__name__}, not a tuple")
+    if snapshot(result) != before:
+        failures.append("fields changed after the attempts to modify them")
+    if copy.copy(result) is not result:
+        failures.append("copy.copy returned a new object")
+    for name, clone in (("deepcopy", copy.deepcopy), ("pickle", lambda r: pickle.loads(pickle.dumps(r)))):
+        try:
+            other = clone(result)
+        except Exception as e:
+            failures.append(f"{name} raised {e.__class__.__name__}: {e}")
+            continue
+        if other is result or (other.code, other.spans, other.confidence) != (result.code, result.spans, result.confidence):
+            failures.append(f"{name} did not give an equal copy")
+    return failures
+
+
+def check_shared_reads(result, threads, rounds):
+    """Readers compare a shared result with its snapshot while writers build new ones"""
+    expected = snapshot(result)
+    stop = threading.Event()
+    failures = []
+
+    def reader():
+        n = 0
+        while not stop.is_set():
+            for key, value in expected.items():
+                if getattr(result, key) is not value:
+                    failures.append(f"shared result's {key} changed")
+                    return n
+            n += 1
+        return n
+
+    def writer(k):
+        for i in range(rounds):
+            code = f"{k:02d}{i % 100:02d}"
+            spans = ((k, i),) * 4
+            confidence = (k / 100, i / rounds, 0.5, 1.0)
+            built = CaptchaRecognitionResult(code, (), spans, (), confidence=confidence)
+            if (built.code, built.spans, built.confidence) != (code, spans, confidence):
+                failures.append(f"writer {k} read back another thread's values")
+                return
+
+    readers = max(threads // 2, 1)
+    with ThreadPoolExecutor(max_workers=threads + readers) as pool:
+        reads = [pool.submit(reader) for _ in range(readers)]
+        writes = [pool.submit(writer, k) for k in range(threads)]
+        for future in writes:
+            future.result()
+        stop.set()
+        total = sum(future.result() for future in reads)
+    return failures, total
+
+
+def recognize(img_bytes):
+    try:
+        result = recognizer.recognize(img_bytes, capture=False)
+        return result.code, result.confidence
+    except ImageProcessorException as e:
+        return e.__class__.__name__, ()
+
+
+def check_recognition(corpus, threads):
+    expected = [recognize(img_bytes) for img_bytes in corpus]
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        got = list(pool.map(recognize, corpus * 4))
+    mismatches = sum(a != expected[i % len(corpus)] for i, a in enumerate(got))
+    return [f"{mismatches} of {len(got)} concurrent recognitions differ"] if mismatches else []
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that recognition results are immutable and thread-safe")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=2000, help="results built by each writer thread")
+    parser.add_argument("-n", type=int, default=100, help="synthetic captchas to recognize")
+    args = parser.parse_args()
+
+    sys.setswitchinterval(1e-6)
+    corpus = [img_bytes for _, img_bytes in CaptchaGenerator(seed=0).generate_many(args.n)]
+    recognizer.warmup()
+    result = None
+    for img_bytes in corpus:
+        try:
+            result = recognizer.recognize(img_bytes, capture=False)
+            break
+        except ImageProcessorException:
+            continue
+
+    report = []
+    failures = check_immutable(result)
+    report.append(("immutable", failures, "fields, copy, deepcopy and pickle"))
+    failures, reads = check_shared_reads(result, args.threads, args.rounds)
+    report.append(("shared reads", failures,
+                   f"{reads} full reads against {args.threads * args.rounds} concurrent constructions"))
+    failures = check_recognition(corpus, args.threads)
+    report.append(("recognition", failures, f"{4 * len(corpus)} recognitions on {args.threads} threads"))
+
+    failed = False
+    for name, failures, detail in report:
+        print(f"{name:13s} {len(failures)} failures, {detail}")
+        for failure in failures[:10]:
+            print("    " + failure)
+        failed |= bool(failures)
+    print("FAILED" if failed else "OK")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""Recover labelled captcha segments from the shipped KNN model
+
+KNN.model.f5.l1.c1.bz2 keeps its whole training matrix: one feature5
+(level 1) vector per segment, with its label. feature5 is a fixed 3x3
+convolution of the 22x22 segment (neighbours weigh 1, the centre 5), so
+when the outer ring of the segment is blank the 20x20 inner pixels can be
+solved for exactly. Segments whose solution is not a 0/1 image that
+reproduces the stored vector are dropped.
+
+The pickle was written by scikit-learn 0.19. Newer versions have renamed
+its modules and changed the KD-tree, so it is unpickled with module
+aliases and the tree replaced by a placeholder; only _fit_X, _y and
+classes_ are used. Needs scikit-learn and joblib.
+
+    python tools/knn_segments.py segments.npz
+
+The output has arrays labels and ink, the format python3 -m
+captcha.calibrate reads.
+"""
+
+import os
+import sys
+import argparse
+import importlib
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, os.path.abspath(ROOT))
+
+from captcha.const import Model_Dir
+from captcha.feature import FeatureExtractor
+
+MODEL = os.path.join(Model_Dir, "KNN.model.f5.l1.c1.bz2")
+
+# Modules the 0.19 pickle refers to, and where they live now
+ALIASES = {
+    "sklearn.externals.joblib": "joblib",
+    "sklearn.externals.joblib.numpy_pickle": "joblib.numpy_pickle",
+    "sklearn.neighbors.classification": "sklearn.neighbors._classification",
+    "sklearn.neighbors.base": "sklearn.neighbors._base",
+}
+
+
+class Placeholder:
+    """Stands in for the KD-tree and distance metric, which aren't needed"""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __setstate__(self, state):
+        pass
+
+
+def load_training_matrix(path=MODEL):
+    """Return (X, labels) from the KNN pickle"""
+    for old, new in ALIASES.items():
+        sys.modules.setdefault(old, importlib.import_module(new))
+    from joblib import numpy_pickle
+
+    find_class = numpy_pickle.NumpyUnpickler.find_class
+
+    def find_class_without_tree(self, module, name):
+        if module.startswith(("sklearn.neighbors.kd_tree", "sklearn.neighbors.dist_metrics")):
+            return Placeholder
+        return find_class(self, module, name)
+
+    numpy_pickle.NumpyUnpickler.find_class = find_class_without_tree
+    try:
+        knn = numpy_pickle.load(path)
+    finally:
+        numpy_pickle.NumpyUnpickler.find_class = find_class
+    return np.asarray(knn._fit_X), knn.classes_[knn._y].astype(str)
+
+
+def _convolution(size=20):
+    """feature5 (level 1) of the inner size x size pixels as a matrix"""
+    A = np.zeros((size * size, size * size))
+    for i in range(size):
+        for j in range(size):
+            for di in (-1, 0, 1):
+                for dj in (-1, 0, 1):
+                    a, b = i + di, j + dj
+                    if 0 <= a < size and 0 <= b < size:
+                        A[i * size + j, a * size + b] = 5 if di == dj == 0 else 1
+    return A
+
+
+def recover(X):
+    """Return (ink, ok): 22x22 0/1 segments and which rows were recovered exactly"""
+    A = _convolution()
+    solution = np.rint(np.linalg.solve(A, X.T.astype(np.float64)).T)
+    ok = np.isin(solution, (0, 1)).all(axis=1) & (np.abs(solution @ A.T - X).max(axis=1) == 0)
+    ink = np.zeros((len(X), 22, 22), dtype=np.uint8)
+    ink[:, 1:21, 1:21] = solution.reshape((-1, 20, 20)).clip(0, 1)
+    return ink, ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recover labelled segments from the KNN model")
+    parser.add_argument("output", help="npz file to write")
+    parser.add_argument("--model", default=MODEL)
+    args = parser.parse_args()
+
+    X, labels = load_training_matrix(args.model)
+    ink, ok = recover(X)
+    ink, labels = ink[ok], labels[ok]
+
+    # Spot check against the real feature extractor
+    feature = FeatureExtractor.get_feature("5", "1")
+    for k in np.linspace(0, len(ink) - 1, 50).astype(int):
+        expected = X[np.flatnonzero(ok)[k]]
+        assert np.array_equal(feature(ink[k] == 0).astype(np.int64), expected.astype(np.int64))
+
+    np.savez_compressed(args.output, labels=labels, ink=ink)
+    print(f"recovered {len(ink)} of {len(X)} segments, {len(set(labels))} classes -> {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Run an EasyElective client end to end against tools/standin_server.py
+
+Starts the stand-in server on a free local port in a background thread,
+points the client's URLs at it and runs the sync client, or the asyncio
+client with --async, in a temporary directory with its own config.yaml and
+targets.csv. Ghost is a target that is never on the course list. Prints
+the server's request counters and exits non-zero unless Algebra and
+Physics were both elected and every course-list request carried the
+session cookie. Needs aiohttp.
+
+    python tools/run_standin.py
+    python tools/run_standin.py --async
+"""
+
+import os
+import sys
+import asyncio
+import argparse
+import tempfile
+import threading
+from time import sleep, monotonic
+
+from aiohttp import web
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, os.path.abspath(ROOT))
+
+import standin_server
+
+CONFIG = f'studentID: "{standin_server.USERNAME}"\npassword: {standin_server.PASSWORD}\ncaptchaValidity: 30\n'
+TARGETS = "courseName,classID,college\nAlgebra,1,Math\nPhysics,2,Phys\nGhost,3,None\n"
+EXPECTED = {"1", "2"}
+
+
+def start_server(app):
+    """Serve app on 127.0.0.1 from a daemon thread and return its base URL"""
+    ready = threading.Event()
+    port = []
+
+    async def serve():
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port.append(runner.addresses[0][1])
+        ready.set()
+        await asyncio.Event().wait()
+
+    threading.Thread(target=lambda: asyncio.run(serve()), daemon=True).start()
+    ready.wait()
+    return f"http://127.0.0.1:{port[0]}"
+
+
+def point_at(ee, base):
+    """Rewrite easyelective's URL constants to go to base instead"""
+    for name in (
+        "IAAA_LOGIN_URL",
+        "ELECTIVE_LOGIN_URL",
+        "SUPPLY_CANCEL_URL",
+        "DRAW_SERVLET_URL",
+        "SUPPLEMENT_URL",
+        "VALIDATE_URL",
+    ):
+        url = getattr(ee, name)
+        url = url.replace("https://iaaa.pku.edu.cn", base).replace(ee.ELECTIVE_BASE_URL, base)
+        setattr(ee, name, url)
+    ee.ELECTIVE_BASE_URL = base
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run EasyElective against the stand-in server")
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="run the asyncio client instead of the sync one",
+    )
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="seconds between course-list polls")
+    args = parser.parse_args()
+
+    app = standin_server.make_app()
+    base = start_server(app)
+
+    # The clients read config.yaml and targets.csv and write their logs in the working directory
+    workdir = tempfile.mkdtemp(prefix="easyelective-standin-")
+    with open(os.path.join(workdir, "config.yaml"), "w") as f:
+        f.write(CONFIG)
+    with open(os.path.join(workdir, "targets.csv"), "w") as f:
+        f.write(TARGETS)
+    os.chdir(workdir)
+
+    import easyelective as ee
+
+    point_at(ee, base)
+    started = monotonic()
+    if args.use_async:
+        import easyelective_async
+
+        easyelective_async.POLL_INTERVAL = args.poll_interval
+        asyncio.run(easyelective_async.main())
+    else:
+        ee.sleep = lambda seconds: sleep(args.poll_interval)
+        ee.main()
+    elapsed = monotonic() - started
+
+    state = app["state"]
+    log = state.pop("log")
+    print(f"elapsed {elapsed:.2f}s, logs in {workdir}")
+    print(state)
+    if log:
+        print([(event, round(t - log[0][1], 2)) for event, t in log])
+    ok = set(state["elects"]) == EXPECTED and state["missing_cookie"] == 0
+    print("OK" if ok else "FAILED")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,149 @@
+"""Local stand-in for the IAAA and elective endpoints EasyElective talks to
+
+Serves just enough of the real sites for a full run of either client:
+IAAA login, the SSO redirect, the supplement course list, captcha images,
+captcha validation and elect.do. The scenario is fixed so runs can be
+compared. Algebra is full for the first two polls and then has a free
+slot, Physics is open from the start, and the second course-list request
+fails with a 503 so the retry path is exercised. Every request is counted
+in the app's "state" dict. Needs aiohttp.
+
+Run it on its own with `python tools/standin_server.py --port 8000`, or
+let tools/run_standin.py start it and point a client at it.
+"""
+
+import os
+import sys
+import random
+import asyncio
+import argparse
+from time import monotonic
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from captcha.synthetic import CaptchaGenerator
+
+USERNAME = "1"
+PASSWORD = "pw"
+SESSION_COOKIE = "abc"
+SUPPLEMENT_PATH = "/elective2008/edu/pku/stu/elective/controller/supplement"
+
+ROW = (
+    '<tr class="datagrid-{parity}">'
+    '<td class="datagrid">{name}</td>' + '<td class="datagrid"></td>' * 4 +
+    '<td class="datagrid">{classID}</td><td class="datagrid">{college}</td>'
+    + '<td class="datagrid"></td>' * 2 +
+    '<td class="datagrid">{limit} / {elected}</td>'
+    '<td class="datagrid"><a href="/elective2008/elect.do?c={classID}">elect</a></td></tr>'
+)
+
+# Courses on the list: (name, classID, college, limit, elected before the
+# first free slot, poll from which one slot is free)
+COURSES = [
+    ("Algebra", 1, "Math", 30, 30, 3),
+    ("Physics", 2, "Phys", 30, 10, 1),
+]
+
+
+def new_state():
+    return {
+        "heads": 0,
+        "supply_calls": 0,
+        "polls": 0,
+        "draws": 0,
+        "validates": 0,
+        "elects": [],
+        "missing_cookie": 0,
+        "log": [],
+    }
+
+
+async def iaaa_login(request):
+    form = await request.post()
+    if form.get("userName") == USERNAME and form.get("password") == PASSWORD:
+        return web.json_response({"success": True, "token": "token"})
+    return web.json_response({"success": False, "errors": {"msg": "wrong password"}})
+
+
+async def sso_login(request):
+    response = web.Response(text="ok")
+    response.set_cookie("JSESSIONID", SESSION_COOKIE)
+    return response
+
+
+async def root(request):
+    request.app["state"]["heads"] += 1
+    return web.Response(text="")
+
+
+async def supply_cancel(request):
+    state = request.app["state"]
+    state["supply_calls"] += 1
+    if state["supply_calls"] == 2:
+        return web.Response(status=503, text="busy")
+    if request.cookies.get("JSESSIONID") != SESSION_COOKIE:
+        state["missing_cookie"] += 1
+    state["polls"] += 1
+    state["log"].append(("poll", monotonic()))
+    await asyncio.sleep(0.05)
+    rows = "".join(
+        ROW.format(
+            parity="even" if i % 2 == 0 else "odd",
+            name=name,
+            classID=classID,
+            college=college,
+            limit=limit,
+            elected=elected if state["polls"] < free_from else min(elected, limit - 1),
+        )
+        for i, (name, classID, college, limit, elected, free_from) in enumerate(COURSES)
+    )
+    return web.Response(text=f'<table class="datagrid">{rows}</table>', content_type="text/html")
+
+
+async def draw_servlet(request):
+    request.app["state"]["draws"] += 1
+    await asyncio.sleep(0.05)
+    _, img_bytes = request.app["captcha"].generate()
+    return web.Response(body=img_bytes, content_type="image/jpeg")
+
+
+async def validate(request):
+    request.app["state"]["validates"] += 1
+    await asyncio.sleep(0.05)
+    # The recognizer can't read these images reliably, so accept at random
+    valid = request.app["random"].random() < 0.6
+    return web.json_response({"valid": "2" if valid else "0"})
+
+
+async def elect(request):
+    state = request.app["state"]
+    state["elects"].append(request.query["c"])
+    state["log"].append(("elect", monotonic()))
+    await asyncio.sleep(0.3)
+    return web.Response(text='<div id="msgTips">选课成功</div>', content_type="text/html")
+
+
+def make_app(seed=1):
+    """Build the stand-in app, with request counters in app["state"]"""
+    app = web.Application()
+    app["state"] = new_state()
+    app["captcha"] = CaptchaGenerator(seed=seed)
+    app["random"] = random.Random(seed)
+    app.router.add_post("/iaaa/oauthlogin.do", iaaa_login)
+    app.router.add_get("/", root)
+    app.router.add_get("/elective2008/ssoLogin.do", sso_login)
+    app.router.add_get(SUPPLEMENT_PATH + "/SupplyCancel.do", supply_cancel)
+    app.router.add_get("/elective2008/DrawServlet", draw_servlet)
+    app.router.add_post(SUPPLEMENT_PATH + "/validate.do", validate)
+    app.router.add_get("/elective2008/elect.do", elect)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stand-in IAAA and elective server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    web.run_app(make_app(), host=args.host, port=args.port)
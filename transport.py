@@ -0,0 +1,287 @@
+"""HTTP transport shared by every request EasyElective makes
+
+One keep-alive connection pool per host sized for the number of threads
+that talk to elective at once. Each endpoint has its own connect and read
+timeouts. Idempotent GETs are retried a bounded number of times with
+jittered exponential backoff. DNS answers are cached, and connections to
+elective can be opened ahead of time and kept alive, so the first request
+after a slot opens doesn't pay for DNS, TCP or TLS setup.
+"""
+
+import socket
+import random
+import threading
+from time import sleep, monotonic
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from loguru import logger
+
+# (connect, read) timeouts in seconds per endpoint
+TIMEOUTS = {
+    "iaaa": (3.05, 10),
+    "login": (3.05, 10),
+    "courses": (3.05, 5),
+    "captcha": (3.05, 3),
+    "validate": (3.05, 3),
+    "elect": (3.05, 5),
+    "keepalive": (3.05, 3),
+}
+DEFAULT_TIMEOUT = (3.05, 5)
+
+# Responses worth retrying for an idempotent GET
+RETRY_STATUS = frozenset({502, 503, 504})
+
+
+class DNSCache:
+    """Cache socket.getaddrinfo answers for `ttl` seconds
+
+    Installing the cache wraps socket.getaddrinfo for the whole process.
+    Lookups that fail are not cached.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._getaddrinfo = None
+
+    def install(self):
+        if self._getaddrinfo is None:
+            self._getaddrinfo = socket.getaddrinfo
+            socket.getaddrinfo = self.getaddrinfo
+        return self
+
+    def uninstall(self):
+        if self._getaddrinfo is not None:
+            socket.getaddrinfo = self._getaddrinfo
+            self._getaddrinfo = None
+
+    def getaddrinfo(self, *args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        now = monotonic()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and now - cached[0] < self.ttl:
+                self.hits += 1
+                return cached[1]
+        answer = self._getaddrinfo(*args, **kwargs)
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = (now, answer)
+        return answer
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+# One cache per process, since it patches socket.getaddrinfo. Creating a
+# Transport doesn't install it; the program's entry point does
+dns_cache = DNSCache()
+
+
+class Transport:
+    """A requests.Session with tuned pools, per-endpoint timeouts and retries
+
+    It can stand in for a requests.Session: get() and post() accept the
+    usual keyword arguments, plus `endpoint` to pick timeouts from TIMEOUTS
+    and `idempotent` to allow retries. GETs are retried unless
+    idempotent=False; POSTs never are. DNS answers are only cached once
+    dns_cache.install() has been called.
+    """
+
+    def __init__(self, headers=None, pool_size=4, retries=2, backoff=0.2, timeouts=None):
+        self.retries = retries
+        self.backoff = backoff
+        self.timeouts = dict(TIMEOUTS, **(timeouts or {}))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if headers:
+            self.session.headers.update(headers)
+        self._keepalive = None
+        self._stop = threading.Event()
+
+    @property
+    def headers(self):
+        return self.session.headers
+
+    @property
+    def cookies(self):
+        return self.session.cookies
+
+    def reset(self):
+        """Forget cookies of the previous login, keeping open connections"""
+
+        self.session.cookies.clear()
+        return self
+
+    def _backoff(self, attempt):
+        # Full jitter: uniform in [0, backoff * 2^attempt]
+        return random.uniform(0, self.backoff * (2 ** attempt))
+
+    def request(self, method, url, endpoint=None, idempotent=None, **kwargs):
+        kwargs.setdefault("timeout", self.timeouts.get(endpoint, DEFAULT_TIMEOUT))
+        if idempotent is None:
+            idempotent = method.upper() in ("GET", "HEAD")
+        attempts = 1 + (self.retries if idempotent else 0)
+        for attempt in range(attempts):
+            last = attempt == attempts - 1
+            try:
+                resp = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if last:
+                    raise
+                logger.debug(f"{method} {endpoint or url} failed ({e.__class__.__name__}), retrying")
+            else:
+                if resp.status_code not in RETRY_STATUS or last:
+                    return resp
+                logger.debug(f"{method} {endpoint or url} returned {resp.status_code}, retrying")
+            sleep(self._backoff(attempt))
+
+    def get(self, url, endpoint=None, **kwargs):
+        return self.request("GET", url, endpoint, **kwargs)
+
+    def post(self, url, endpoint=None, **kwargs):
+        return self.request("POST", url, endpoint, **kwargs)
+
+    def head(self, url, endpoint=None, **kwargs):
+        return self.request("HEAD", url, endpoint, **kwargs)
+
+    def prewarm(self, url, connections=2):
+        """Open `connections` pooled connections to the host of `url`
+
+        The requests run at the same time, so each one takes its own
+        connection, which goes back to the pool afterwards.
+        """
+
+        def _touch():
+            try:
+                self.head(url, endpoint="keepalive", idempotent=False, allow_redirects=False)
+            except requests.exceptions.RequestException:
+                pass
+
+        started = monotonic()
+        threads = [threading.Thread(target=_touch) for _ in range(connections)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        logger.debug(f"Prewarmed {connections} connections to {urlsplit(url).netloc} in {monotonic() - started:.3f}s")
+
+    def start_keepalive(self, url, interval=30, connections=2):
+        """Keep connections to `url` open by touching them every `interval` seconds"""
+
+        if self._keepalive is not None:
+            return self
+        self._stop.clear()
+
+        def _run():
+            while not self._stop.wait(interval):
+                self.prewarm(url, connections)
+
+        self.prewarm(url, connections)
+        self._keepalive = threading.Thread(target=_run, name="Keepalive", daemon=True)
+        self._keepalive.start()
+        return self
+
+    def stop_keepalive(self):
+        self._stop.set()
+        self._keepalive = None
+
+    def close(self):
+        self.stop_keepalive()
+        self.session.close()
+
+
+class AsyncTransport:
+    """The aiohttp counterpart of Transport, for easyelective_async
+
+    Timeouts, retries and pool sizing follow the same rules. DNS caching
+    uses aiohttp's own resolver cache, so nothing is patched globally. fetch() returns (status, body), with
+    the body read as "text", "bytes" or "json".
+    """
+
+    def __init__(self, headers=None, pool_size=4, retries=2, backoff=0.2, dns_ttl=300, timeouts=None):
+        import aiohttp
+
+        self._aiohttp = aiohttp
+        self.retries = retries
+        self.backoff = backoff
+        self.timeouts = dict(TIMEOUTS, **(timeouts or {}))
+        connector = aiohttp.TCPConnector(limit_per_host=pool_size, ttl_dns_cache=dns_ttl or None, use_dns_cache=dns_ttl > 0)
+        # unsafe=True keeps cookies of hosts given by IP address
+        self.session = aiohttp.ClientSession(
+            headers=headers, connector=connector, cookie_jar=aiohttp.CookieJar(unsafe=True)
+        )
+        self._keepalive = None
+
+    def reset(self):
+        self.session.cookie_jar.clear()
+        return self
+
+    def _timeout(self, endpoint):
+        connect, read = self.timeouts.get(endpoint, DEFAULT_TIMEOUT)
+        return self._aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+
+    async def fetch(self, method, url, endpoint=None, read="text", idempotent=None, **kwargs):
+        import asyncio
+
+        kwargs.setdefault("timeout", self._timeout(endpoint))
+        if idempotent is None:
+            idempotent = method.upper() in ("GET", "HEAD")
+        attempts = 1 + (self.retries if idempotent else 0)
+        for attempt in range(attempts):
+            last = attempt == attempts - 1
+            try:
+                async with self.session.request(method, url, **kwargs) as resp:
+                    if resp.status in RETRY_STATUS and not last:
+                        logger.debug(f"{method} {endpoint or url} returned {resp.status}, retrying")
+                    elif read == "json":
+                        return resp.status, await resp.json(content_type=None)
+                    elif read == "bytes":
+                        return resp.status, await resp.read()
+                    else:
+                        return resp.status, await resp.text()
+            except (self._aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if last:
+                    raise
+                logger.debug(f"{method} {endpoint or url} failed ({e.__class__.__name__}), retrying")
+            await asyncio.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+    async def prewarm(self, url, connections=2):
+        import asyncio
+
+        async def _touch():
+            try:
+                await self.fetch("HEAD", url, endpoint="keepalive", idempotent=False, allow_redirects=False)
+            except (self._aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+
+        await asyncio.gather(*(_touch() for _ in range(connections)))
+
+    def start_keepalive(self, url, interval=30, connections=2):
+        import asyncio
+
+        async def _run():
+            while True:
+                await self.prewarm(url, connections)
+                await asyncio.sleep(interval)
+
+        if self._keepalive is None:
+            self._keepalive = asyncio.create_task(_run())
+        return self
+
+    def stop_keepalive(self):
+        if self._keepalive is not None:
+            self._keepalive.cancel()
+            self._keepalive = None
+
+    async def close(self):
+        self.stop_keepalive()
+        await self.session.close()